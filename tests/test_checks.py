@@ -18,3 +18,23 @@ class InstallAppOrderCheckTest(TestCase):
     def test_two_factor_not_found(self):
         self.assertEqual(checks.check_installed_app_order(None),
             [Warning(checks.MISSING_MSG, hint=checks.MISSING_HINT, id=checks.MISSING_ID)])
+
+
+class BackupTokensCheckTest(TestCase):
+    def test_correct(self):
+        self.assertEqual(checks.check_backup_tokens(None), [])
+
+    def test_length(self):
+        for length in [0, 17, '8']:
+            with self.subTest(length=length), override_settings(TWO_FACTOR_BACKUP_TOKEN_LENGTH=length):
+                self.assertEqual(checks.check_backup_tokens(None), [Error(
+                    checks.BACKUP_TOKEN_LENGTH_MSG, hint=checks.BACKUP_TOKEN_LENGTH_HINT,
+                    id=checks.BACKUP_TOKEN_LENGTH_ID)])
+
+    def test_count(self):
+        for count, length in [(0, 8), (33, 1), (None, 8)]:
+            with self.subTest(count=count), override_settings(TWO_FACTOR_BACKUP_TOKEN_COUNT=count,
+                                                              TWO_FACTOR_BACKUP_TOKEN_LENGTH=length):
+                self.assertEqual(checks.check_backup_tokens(None), [Error(
+                    checks.BACKUP_TOKEN_COUNT_MSG, hint=checks.BACKUP_TOKEN_COUNT_HINT,
+                    id=checks.BACKUP_TOKEN_COUNT_ID)])
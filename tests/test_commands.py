@@ -1,14 +1,39 @@
+import json
 import os
+from datetime import timedelta
 from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest import mock, skipUnless
 
+from django.contrib.auth import get_user_model
 from django.core.management import CommandError, call_command
-from django.test import TestCase
-from django_otp import devices_for_user
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django_otp import device_classes, devices_for_user
+from django_otp.plugins.otp_static.models import StaticDevice
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from two_factor.models import RememberDeviceToken
+from two_factor.plugins.phonenumber.models import PhoneDevice
+from two_factor.plugins.registry import registry
 
 from .utils import UserMixin
 
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
+
+class FileMixin:
+    def write_lines(self, *lines):
+        with NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(lines) + '\n')
+        self.addCleanup(os.remove, f.name)
+        return f.name
 
-class DisableCommandTest(UserMixin, TestCase):
+
+class DisableCommandTest(FileMixin, UserMixin, TestCase):
     def _assert_raises(self, err_type, err_message):
         return self.assertRaisesMessage(err_type, err_message)
 
@@ -40,8 +65,59 @@ class DisableCommandTest(UserMixin, TestCase):
         self.assertEqual(list(devices_for_user(users[1])), [])
         self.assertNotEqual(list(devices_for_user(users[2])), [])
 
+    def test_disable_from_file(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(4)]
+        for user in users:
+            self.enable_otp(user)
+        users[0].staticdevice_set.create(name='backup').token_set.create(token='abcdef123')
+        # Unconfirmed devices are left alone, like devices_for_user() does
+        unconfirmed = users[1].totpdevice_set.create(name='setup', confirmed=False)
+        path = self.write_lines('user0@example.com', 'unknown', 'user1@example.com', 'user2@example.com')
+
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command('two_factor_disable', '--from-file', path, '--dry-run', '--chunk-size', '2',
+                     stdout=stdout, stderr=stderr)
+        self.assertEqual(stderr.getvalue(), 'User "unknown" does not exist\n')
+        self.assertIn('Would delete 4 devices of 3 users\n', stdout.getvalue())
+        self.assertIn('  otp_totp.TOTPDevice: 3\n', stdout.getvalue())
+        self.assertEqual(len(list(devices_for_user(users[0]))), 2)
 
-class StatusCommandTest(UserMixin, TestCase):
+        stdout = StringIO()
+        call_command('two_factor_disable', '--from-file', path, '--chunk-size', '2',
+                     stdout=stdout, stderr=StringIO())
+        self.assertIn('Deleted 4 devices of 3 users\n', stdout.getvalue())
+        for user in users[:3]:
+            self.assertEqual(list(devices_for_user(user)), [])
+        self.assertTrue(TOTPDevice.objects.filter(pk=unconfirmed.pk).exists())
+        self.assertNotEqual(list(devices_for_user(users[3])), [])
+
+    def test_disable_ids(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(2)]
+        for user in users:
+            self.enable_otp(user)
+        stdout = StringIO()
+        call_command('two_factor_disable', '--from-file', self.write_lines(str(users[1].pk)), '--ids',
+                     stdout=stdout)
+        self.assertNotEqual(list(devices_for_user(users[0])), [])
+        self.assertEqual(list(devices_for_user(users[1])), [])
+
+        with self._assert_raises(CommandError, 'Invalid primary key'):
+            call_command('two_factor_disable', '--from-file', self.write_lines('abc'), '--ids',
+                         stdout=stdout)
+
+    def test_disable_is_set_based(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(10)]
+        for user in users:
+            self.enable_otp(user)
+        # The users, the transaction and one query per device model (a SELECT
+        # for models with cascading relations, such as StaticDevice's tokens)
+        with self.assertNumQueries(1 + 2 + len(list(device_classes()))):
+            call_command('two_factor_disable', *[user.get_username() for user in users])
+        self.assertFalse(TOTPDevice.objects.exists())
+
+
+class StatusCommandTest(FileMixin, UserMixin, TestCase):
     def _assert_raises(self, err_type, err_message):
         return self.assertRaisesMessage(err_type, err_message)
 
@@ -80,3 +156,306 @@ class StatusCommandTest(UserMixin, TestCase):
         call_command('two_factor_status', 'user0@example.com', 'user1@example.com', stdout=stdout)
         self.assertEqual(stdout.getvalue(), 'user0@example.com: enabled\n'
                                             'user1@example.com: disabled\n')
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    def test_status_all(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(5)]
+        self.enable_otp(users[0])
+        users[1].phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        users[2].totpdevice_set.create(name='default', confirmed=False)
+
+        stdout = StringIO()
+        # The users, then one query per device model for each chunk
+        with self.assertNumQueries(1 + 2 * len(list(device_classes()))):
+            call_command('two_factor_status', '--all', '--format', 'json', '--chunk-size', '3',
+                         stdout=stdout)
+        self.assertEqual([json.loads(line) for line in stdout.getvalue().splitlines()], [
+            {'username': 'user0@example.com', 'enabled': True, 'method': 'generator'},
+            {'username': 'user1@example.com', 'enabled': True, 'method': 'sms'},
+            {'username': 'user2@example.com', 'enabled': False, 'method': None},
+            {'username': 'user3@example.com', 'enabled': False, 'method': None},
+            {'username': 'user4@example.com', 'enabled': False, 'method': None},
+        ])
+
+    def test_status_from_file(self):
+        users = [self.create_user(n) for n in ['user0@example.com', 'user1@example.com']]
+        self.enable_otp(users[1])
+        path = self.write_lines('user1@example.com', 'unknown', 'user0@example.com')
+
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command('two_factor_status', '--from-file', path, '--format', 'csv',
+                     stdout=stdout, stderr=stderr)
+        self.assertEqual(stdout.getvalue(), 'username,enabled,method\n'
+                                            'user1@example.com,True,generator\n'
+                                            'user0@example.com,False,\n')
+        self.assertEqual(stderr.getvalue(), 'User "unknown" does not exist\n')
+
+
+@override_settings(
+    TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake',
+    TWO_FACTOR_CALL_GATEWAY='two_factor.gateways.fake.Fake',
+)
+class ReportCommandTest(UserMixin, TestCase):
+    def test_report(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(5)]
+        self.enable_otp(users[0])
+        users[1].phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        users[1].phonedevice_set.create(name='backup', number='+31101234568', method='sms')
+        users[1].phonedevice_set.create(name='backup', number='+31101234569', method='call')
+        # Counted once, for the first device model with a default device
+        self.enable_otp(users[2])
+        users[2].phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        users[3].phonedevice_set.create(name='default', number='+31101234567', method='sms', confirmed=False)
+        users[4].staticdevice_set.create(name='backup').token_set.create(token='abcdef123')
+        device = users[0].staticdevice_set.create(name='backup')
+        device.token_set.create(token='abcdef123')
+        device.hashed_token_set.create(token_hash='0' * 64)
+
+        # The users, one query per device model, the tokens, the backup phones
+        # and the WebAuthn keys, if installed.
+        webauthn = any(method.code == 'webauthn' for method in registry.get_methods())
+        with self.assertNumQueries(1 + len(list(device_classes())) + 2 + 1 + webauthn):
+            stdout = StringIO()
+            call_command('two_factor_report', stdout=stdout)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['users'], 5)
+        self.assertEqual(report['enabled_users'], 3)
+        self.assertEqual(report['methods']['generator'], 2)
+        self.assertEqual(report['methods']['sms'], 1)
+        self.assertEqual(report['methods']['call'], 0)
+        self.assertEqual(report['backup_tokens'], {'users': 2, 'tokens': 3})
+        self.assertEqual(report['backup_phones'], {'users': 1, 'devices': 2})
+        if webauthn:
+            self.assertEqual(report['webauthn_keys'], {'users': 0, 'keys': 0})
+
+        stdout = StringIO()
+        call_command('two_factor_report', '--format', 'csv', stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[:3], ['metric,value', 'users,5', 'enabled_users,3'])
+        self.assertIn('methods.generator,2', lines)
+        self.assertIn('backup_tokens.tokens,3', lines)
+
+    def test_report_unknown_method(self):
+        self.enable_otp(self.create_user('user0@example.com'))
+        # No method handles static devices
+        self.create_user('user1@example.com').staticdevice_set.create(name='default')
+        stdout = StringIO()
+        call_command('two_factor_report', stdout=stdout)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['enabled_users'], 2)
+        self.assertEqual(report['methods']['generator'], 1)
+        self.assertEqual(report['methods']['unknown'], 1)
+
+
+class PruneCommandTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.old = timezone.now() - timedelta(days=30)
+
+    def test_prune(self):
+        confirmed = self.enable_otp(self.user)
+        stale = self.user.totpdevice_set.create(name='default', confirmed=False)
+        pending = self.user.totpdevice_set.create(name='default', confirmed=False)
+        phone = self.user.phonedevice_set.create(name='default', number='+31101234567', confirmed=False)
+        empty = self.user.staticdevice_set.create(name='backup')
+        backup = self.user.staticdevice_set.create(name='backup')
+        backup.token_set.create(token='abcdef123')
+        hashed = self.user.staticdevice_set.create(name='backup')
+        hashed.hashed_token_set.create(token_hash='0' * 64)
+        TOTPDevice.objects.filter(pk__in=[confirmed.pk, stale.pk]).update(created_at=self.old)
+        StaticDevice.objects.update(created_at=self.old)
+
+        stdout = StringIO()
+        call_command('two_factor_prune', '--dry-run', stdout=stdout, stderr=StringIO())
+        self.assertIn('Would delete 2 rows\n', stdout.getvalue())
+        self.assertEqual(TOTPDevice.objects.count(), 3)
+
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command('two_factor_prune', '--batch-size', '1', stdout=stdout, stderr=stderr)
+        self.assertIn('unconfirmed otp_totp.TOTPDevice: 1\n', stdout.getvalue())
+        self.assertIn('static devices without tokens: 1\n', stdout.getvalue())
+        self.assertIn('Deleted 2 rows\n', stdout.getvalue())
+        self.assertQuerySetEqual(TOTPDevice.objects.order_by('pk'), [confirmed, pending])
+        # Phone devices have no creation date, they may be being set up
+        self.assertIn('Skipped unconfirmed phonenumber.PhoneDevice, it has no creation date\n',
+                      stderr.getvalue())
+        self.assertTrue(PhoneDevice.objects.filter(pk=phone.pk).exists())
+        self.assertQuerySetEqual(StaticDevice.objects.order_by('pk'), [backup, hashed])
+        self.assertFalse(StaticDevice.objects.filter(pk=empty.pk).exists())
+
+    def test_prune_without_creation_date(self):
+        self.user.staticdevice_set.create(name='backup')
+        self.user.totpdevice_set.create(name='default', confirmed=False)
+        StaticDevice.objects.update(created_at=None)
+        TOTPDevice.objects.update(created_at=None)
+
+        stdout = StringIO()
+        call_command('two_factor_prune', stdout=stdout, stderr=StringIO())
+        self.assertIn('Deleted 2 rows\n', stdout.getvalue())
+        self.assertFalse(StaticDevice.objects.exists())
+        self.assertFalse(TOTPDevice.objects.exists())
+
+    def test_prune_batches(self):
+        for _ in range(5):
+            self.user.totpdevice_set.create(name='default', confirmed=False)
+        TOTPDevice.objects.update(created_at=self.old)
+        with mock.patch('two_factor.management.commands.two_factor_prune.time.sleep') as sleep:
+            call_command('two_factor_prune', '--batch-size', '2', '--sleep', '0.5', stdout=StringIO(),
+                         stderr=StringIO())
+        self.assertFalse(TOTPDevice.objects.exists())
+        # Not after the last batch
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5)] * 2)
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_REGISTRY=True)
+    def test_prune_remember_tokens(self):
+        device = self.enable_otp(self.user)
+        expires_at = timezone.now() + timedelta(days=1)
+        valid = RememberDeviceToken.objects.create(
+            token_hash='a', user=self.user, device_id=device.persistent_id, expires_at=expires_at)
+        RememberDeviceToken.objects.create(
+            token_hash='b', user=self.user, device_id=device.persistent_id, expires_at=self.old)
+        RememberDeviceToken.objects.create(
+            token_hash='c', user=self.user, device_id=device.persistent_id, expires_at=expires_at, revoked=True)
+
+        call_command('two_factor_prune', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(RememberDeviceToken.objects.count(), 3)
+        call_command('two_factor_prune', '--remember-tokens', stdout=StringIO(), stderr=StringIO())
+        self.assertQuerySetEqual(RememberDeviceToken.objects.all(), [valid])
+
+    def test_prune_webauthn_keys(self):
+        if not any(method.code == 'webauthn' for method in registry.get_methods()):
+            self.skipTest('WebAuthn is not installed')
+        keys = [
+            self.user.webauthn_keys.create(name='default', public_key='key', key_handle=str(i), sign_count=0)
+            for i in range(3)
+        ]
+        keys[0].__class__.objects.filter(pk=keys[0].pk).update(last_used_at=self.old)
+        keys[1].__class__.objects.filter(pk=keys[1].pk).update(created_at=self.old)
+        keys[2].__class__.objects.filter(pk=keys[2].pk).update(created_at=self.old, last_used_at=timezone.now())
+
+        call_command('two_factor_prune', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(self.user.webauthn_keys.count(), 3)
+        call_command('two_factor_prune', '--webauthn-unused-days', '7', stdout=StringIO(), stderr=StringIO())
+        self.assertQuerySetEqual(self.user.webauthn_keys.all(), [keys[2]])
+
+
+@skipUnless(Fernet, 'package cryptography is not present')
+@override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+class ExportImportCommandTest(FileMixin, UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.key_file = self.write_lines(Fernet.generate_key().decode())
+
+    def export(self, *args):
+        stdout = StringIO()
+        call_command('two_factor_export', '--key-file', self.key_file, *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_export_import(self):
+        alice = self.create_user('alice@example.com')
+        bob = self.create_user('bob@example.com')
+        self.create_user('carol@example.com')
+        totp = self.enable_otp(alice)
+        alice.phonedevice_set.create(name='backup', number='+31101234567', method='sms')
+        backup = alice.staticdevice_set.create(name='backup')
+        backup.token_set.create(token='abcdef123')
+        backup.hashed_token_set.create(token_hash='0' * 64)
+        bob.totpdevice_set.create(name='default', confirmed=False)
+
+        with self.assertNumQueries(1 + len(list(device_classes())) + 2):
+            exported = self.export('--all')
+        lines = exported.splitlines()
+        self.assertEqual([json.loads(line)['user'] for line in lines], ['alice@example.com', 'bob@example.com'])
+        self.assertNotIn(totp.key, exported)
+        self.assertNotIn('abcdef123', exported)
+        exported = self.export('--from-file', self.write_lines('bob@example.com'))
+        self.assertEqual([json.loads(line)['user'] for line in exported.splitlines()], ['bob@example.com'])
+
+        # Import in another deployment
+        for model in device_classes():
+            model.objects.all().delete()
+        bob.delete()
+        path = self.write_lines(*lines)
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command('two_factor_import', path, '--key-file', self.key_file, stdout=stdout, stderr=stderr)
+        self.assertEqual(stdout.getvalue(), 'Imported 3 devices of 1 users\n')
+        self.assertEqual(stderr.getvalue(), 'User "bob@example.com" does not exist\n')
+        new_totp = alice.totpdevice_set.get()
+        self.assertEqual((new_totp.name, new_totp.key, new_totp.confirmed), ('default', totp.key, True))
+        self.assertEqual(alice.phonedevice_set.get().number, '+31101234567')
+        new_backup = alice.staticdevice_set.get()
+        self.assertEqual([t.token for t in new_backup.token_set.all()], ['abcdef123'])
+        self.assertEqual([t.token_hash for t in new_backup.hashed_token_set.all()], ['0' * 64])
+
+        # Users with devices are skipped, unless replaced
+        stderr = StringIO()
+        call_command('two_factor_import', path, '--key-file', self.key_file, stdout=StringIO(), stderr=stderr)
+        self.assertIn('User "alice@example.com" already has devices, skipped\n', stderr.getvalue())
+        self.assertEqual(len(list(devices_for_user(alice))), 3)
+        call_command('two_factor_import', path, '--replace', '--key-file', self.key_file,
+                     stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(len(list(devices_for_user(alice))), 3)
+        self.assertNotEqual(alice.totpdevice_set.get().pk, new_totp.pk)
+
+    def test_import_wrong_key(self):
+        self.enable_otp(self.create_user())
+        path = self.write_lines(*self.export('--all').splitlines())
+        self.key_file = self.write_lines(Fernet.generate_key().decode())
+        with self.assertRaisesMessage(CommandError, 'Could not decrypt the devices of user "bouke@example.com"'):
+            call_command('two_factor_import', path, '--key-file', self.key_file, stdout=StringIO())
+
+    def test_import_malformed_line(self):
+        alice = self.create_user('alice@example.com')
+        self.enable_otp(alice)
+        line = self.export('--all').strip()
+        alice.totpdevice_set.all().delete()
+
+        for malformed in ['{"user": "bob@example.com"', '"alice@example.com"', '{"user": "bob@example.com"}']:
+            path = self.write_lines(line, '', malformed)
+            with self.subTest(malformed=malformed):
+                with self.assertRaisesMessage(CommandError, 'Line 3 is not an exported user.'):
+                    call_command('two_factor_import', path, '--key-file', self.key_file,
+                                 '--chunk-size', '1', stdout=StringIO())
+                # Nothing was imported, although the first line is valid
+                self.assertFalse(alice.totpdevice_set.exists())
+
+    def test_import_stdin(self):
+        alice = self.create_user('alice@example.com')
+        self.enable_otp(alice)
+        exported = self.export('--all')
+        alice.totpdevice_set.all().delete()
+
+        stdout = StringIO()
+        with mock.patch('sys.stdin', StringIO(exported)):
+            call_command('two_factor_import', '-', '--key-file', self.key_file, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Imported 1 devices of 1 users\n')
+        self.assertTrue(alice.totpdevice_set.exists())
+
+
+class LoadTestCommandTest(UserMixin, TestCase):
+    def test_loadtest(self):
+        user = self.create_user()
+        for method, steps in [
+            ('generator', ['start', 'auth', 'token']),
+            ('sms', ['start', 'auth', 'token']),
+            ('backup', ['start', 'auth', 'goto_backup', 'backup']),
+        ]:
+            with self.subTest(method=method):
+                stdout = StringIO()
+                call_command('two_factor_loadtest', '--users', '3', '--threads', '1', '--method', method,
+                             stdout=stdout)
+                lines = stdout.getvalue().splitlines()
+                self.assertRegex(lines[0], r'^3 logins in [\d.]+ s, [\d.]+ logins/s, 0 failed$')
+                self.assertEqual([line.split()[0] for line in lines[2:]], steps)
+                self.assertEqual([line.split()[1] for line in lines[2:]], ['3'] * len(steps))
+                # The synthetic users are deleted
+                self.assertQuerySetEqual(get_user_model().objects.all(), [user])
+
+    def test_loadtest_existing_users(self):
+        self.create_user('two_factor_loadtest_0')
+        with self.assertRaisesMessage(CommandError, 'Users starting with "two_factor_loadtest_" already exist'):
+            call_command('two_factor_loadtest', stdout=StringIO())
@@ -1,4 +1,4 @@
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 from urllib.parse import urlencode
 from xml.etree import ElementTree
 
@@ -9,6 +9,7 @@ from django.urls import reverse
 from django.utils import translation
 from phonenumber_field.phonenumber import PhoneNumber
 
+from two_factor.gateways import asend_sms
 from two_factor.gateways.fake import Fake
 from two_factor.gateways.twilio.gateway import Twilio
 
@@ -186,3 +187,34 @@ class FakeGatewayTest(TestCase):
             fake.send_sms(device=Mock(number=PhoneNumber.from_string('+123')), token=code)
             logger.info.assert_called_with(
                 'Fake SMS to %s: "Your token is: %s"', '+123', code)
+
+    @patch('two_factor.gateways.fake.logger')
+    async def test_async_gateway(self, logger):
+        device = Mock(number=PhoneNumber.from_string('+123'))
+        await Fake().amake_call(device=device, token='654321')
+        logger.info.assert_called_with('Fake call to %s: "Your token is: %s"', '+123', '654321')
+
+        await Fake().asend_sms(device=device, token='654321')
+        logger.info.assert_called_with('Fake SMS to %s: "Your token is: %s"', '+123', '654321')
+
+
+class SyncGateway:
+    send_sms = Mock()
+
+
+class AsyncGateway:
+    asend_sms = AsyncMock()
+
+
+class AsyncGatewayFunctionsTest(TestCase):
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='tests.test_gateways.AsyncGateway')
+    async def test_async_gateway(self):
+        device = Mock()
+        await asend_sms(device=device, token='123456')
+        AsyncGateway.asend_sms.assert_awaited_once_with(device=device, token='123456')
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='tests.test_gateways.SyncGateway')
+    async def test_sync_gateway(self):
+        device = Mock()
+        await asend_sms(device=device, token='123456')
+        SyncGateway.send_sms.assert_called_once_with(device=device, token='123456')
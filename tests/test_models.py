@@ -0,0 +1,171 @@
+from datetime import datetime, timezone
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django_otp.util import random_hex
+from freezegun import freeze_time
+
+from two_factor.models import (
+    REMEMBER_TOKEN_CACHE_GENERATION_KEY, RememberDeviceToken,
+)
+from two_factor.plugins.phonenumber.models import PhoneDevice
+from two_factor.views.utils import get_remember_device_cookie
+
+from .utils import UserMixin
+
+
+@override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+class RememberDeviceTokenTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+        self.device = self.user.totpdevice_set.create(name='default', key=random_hex())
+
+    def register(self, user=None):
+        user = user or self.user
+        cookie = get_remember_device_cookie(user=user, otp_device_id=self.device.persistent_id)
+        RememberDeviceToken.objects.register(cookie, user=user, otp_device_id=self.device.persistent_id)
+        return cookie
+
+    def test_only_hash_is_stored(self):
+        cookie = self.register()
+        token = RememberDeviceToken.objects.get()
+        self.assertNotEqual(token.token_hash, cookie)
+        self.assertNotIn(cookie, token.token_hash)
+        self.assertEqual(token.device_id, self.device.persistent_id)
+
+    def test_is_registered(self):
+        cookie = self.register()
+        self.assertTrue(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+        self.assertFalse(RememberDeviceToken.objects.is_registered('unknown', user=self.user))
+
+        other_user = self.create_user('vedran@example.com')
+        self.assertFalse(RememberDeviceToken.objects.is_registered(cookie, user=other_user))
+
+    def test_is_registered_cached(self):
+        cookie = self.register()
+        with self.assertNumQueries(1):
+            self.assertTrue(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+
+    def test_expired(self):
+        cookie = self.register()
+        with freeze_time(RememberDeviceToken.objects.get().expires_at):
+            self.assertFalse(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+
+    def test_bulk_revoke(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(5)]
+        cookies = [self.register(user) for user in users]
+        kept_cookie = self.register()
+        for user, cookie in zip(users, cookies):
+            self.assertTrue(RememberDeviceToken.objects.is_registered(cookie, user=user))
+
+        with self.assertNumQueries(1):
+            count = RememberDeviceToken.objects.filter(user__in=users).revoke()
+        self.assertEqual(count, 5)
+
+        # Cached results are invalidated by the revocation
+        for user, cookie in zip(users, cookies):
+            self.assertFalse(RememberDeviceToken.objects.is_registered(cookie, user=user))
+        self.assertTrue(RememberDeviceToken.objects.is_registered(kept_cookie, user=self.user))
+
+    def test_revoke_generation_evicted(self):
+        cookie = self.register()
+        self.assertTrue(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+        cache.delete(REMEMBER_TOKEN_CACHE_GENERATION_KEY)
+        self.assertTrue(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+        RememberDeviceToken.objects.revoke()
+
+        # Earlier generations don't come back when the current one is evicted
+        cache.delete(REMEMBER_TOKEN_CACHE_GENERATION_KEY)
+        self.assertFalse(RememberDeviceToken.objects.is_registered(cookie, user=self.user))
+
+
+@override_settings(TWO_FACTOR_THROTTLE_CACHE=True, TWO_FACTOR_PHONE_THROTTLE_FACTOR=1)
+class CachedThrottlingTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+        self.device = self.user.phonedevice_set.create(name='default', number='+31101234567',
+                                                       method='sms')
+
+    def fresh_device(self):
+        return PhoneDevice.objects.get(pk=self.device.pk)
+
+    def test_writes_escalations(self):
+        with freeze_time('2024-01-01 00:00:00'):
+            with self.assertNumQueries(1):
+                self.assertFalse(self.device.verify_token('000000'))
+            # Refused during the lockout, without counting the attempt
+            with self.assertNumQueries(0):
+                self.assertFalse(self.device.verify_token('000000'))
+        # Waiting for the throttle delay after each failure
+        for timestamp in ('00:00:01', '00:00:03', '00:00:07'):
+            with freeze_time('2024-01-01 ' + timestamp), self.assertNumQueries(1):
+                self.assertFalse(self.device.verify_token('000000'))
+        self.assertEqual(self.device.throttling_failure_count, 4)
+        device = self.fresh_device()
+        self.assertEqual(device.throttling_failure_count, 4)
+        self.assertEqual(device.throttling_failure_timestamp, datetime(2024, 1, 1, 0, 0, 7, tzinfo=timezone.utc))
+
+        # The state in the cache is shared with other instances
+        with freeze_time('2024-01-01 00:00:14'):
+            allowed, data = self.fresh_device().verify_is_allowed()
+            self.assertFalse(allowed)
+            self.assertEqual(data['failure_count'], 4)
+
+    def test_cache_lost(self):
+        with freeze_time('2024-01-01 00:00:00'):
+            for _ in range(4):
+                self.fresh_device().throttle_increment()
+        cache.clear()
+        with freeze_time('2024-01-01 00:00:07'):
+            allowed, data = self.fresh_device().verify_is_allowed()
+            self.assertFalse(allowed)
+            self.assertEqual(data['failure_count'], 4)
+        with freeze_time('2024-01-01 00:00:08'):
+            self.assertTrue(self.fresh_device().verify_is_allowed()[0])
+
+    def test_cache_evicted_before_incr(self):
+        self.device.throttle_increment()
+        with mock.patch('two_factor.models.cache.incr', side_effect=ValueError):
+            self.device.throttle_increment()
+        self.assertEqual(cache.get(self.device.get_throttle_cache_keys()[0]), 2)
+        self.assertEqual(self.fresh_device().throttling_failure_count, 2)
+
+    def test_cache_timeout(self):
+        with mock.patch('two_factor.models.cache') as mock_cache:
+            mock_cache.incr.return_value = 1
+            self.device.throttle_increment(commit=False)
+        timeouts = [c.args[2] for c in mock_cache.add.call_args_list + mock_cache.set.call_args_list]
+        self.assertEqual(timeouts, [24 * 3600, 24 * 3600])
+        mock_cache.touch.assert_called_once_with(mock.ANY, 24 * 3600)
+
+    def test_verify_is_allowed_across_instances(self):
+        with freeze_time('2024-01-01 00:00:00'):
+            for _ in range(3):
+                self.fresh_device().throttle_increment()
+        device = self.fresh_device()
+        with freeze_time('2024-01-01 00:00:03'):
+            allowed, data = device.verify_is_allowed()
+            self.assertFalse(allowed)
+            self.assertEqual(data['failure_count'], 3)
+        with freeze_time('2024-01-01 00:00:04'):
+            self.assertTrue(self.fresh_device().verify_is_allowed()[0])
+
+    def test_reset(self):
+        with self.assertNumQueries(0):
+            self.device.throttle_reset()
+
+        self.device.throttle_increment()
+        self.device.throttle_increment()
+        device = self.fresh_device()
+        device.verify_is_allowed()
+        with self.assertNumQueries(1):
+            device.throttle_reset()
+        self.assertEqual(self.fresh_device().throttling_failure_count, 0)
+        self.assertTrue(self.fresh_device().verify_is_allowed()[0])
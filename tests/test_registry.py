@@ -1,5 +1,11 @@
+from unittest import mock
+
 from django.test import TestCase
+from django_otp.plugins.otp_static.models import StaticDevice
+from django_otp.plugins.otp_totp.models import TOTPDevice
 
+from two_factor.plugins.phonenumber.method import PhoneCallMethod, SMSMethod
+from two_factor.plugins.phonenumber.models import PhoneDevice
 from two_factor.plugins.registry import (
     GeneratorMethod, MethodBase, MethodNotFoundError, registry,
 )
@@ -9,6 +15,11 @@ class FakeMethod(MethodBase):
     code = 'fake-method'
 
 
+class ConfirmedGeneratorMethod(GeneratorMethod):
+    def get_devices(self, user):
+        return super().get_devices(user).filter(confirmed=True)
+
+
 class RegistryTest(TestCase):
     def setUp(self) -> None:
         self.old_methods = list(registry._methods)
@@ -49,3 +60,41 @@ class RegistryTest(TestCase):
     def test_unknown_method(self):
         with self.assertRaises(MethodNotFoundError):
             registry.get_method("not-existing-method")
+
+    def test_method_from_device(self):
+        registry.register(PhoneCallMethod())
+        registry.register(SMSMethod())
+
+        self.assertEqual(registry.method_from_device(TOTPDevice()).code, 'generator')
+        self.assertEqual(registry.method_from_device(PhoneDevice(method='call')).code, 'call')
+        self.assertEqual(registry.method_from_device(PhoneDevice(method='sms')).code, 'sms')
+
+    def test_method_from_device_by_type(self):
+        method = registry.get_method('generator')
+        with mock.patch.object(FakeMethod, 'recognize_device') as recognize_device:
+            registry._methods = [FakeMethod()] + registry._methods
+            self.assertIs(registry.method_from_device(TOTPDevice()), method)
+        # Methods are only asked in turn when the device type isn't indexed
+        self.assertFalse(recognize_device.called)
+
+    def test_method_from_device_default(self):
+        registry.unregister('generator')
+        method = registry.method_from_device(StaticDevice())
+        self.assertIsInstance(method, GeneratorMethod)
+        self.assertIs(registry.method_from_device(StaticDevice()), method)
+
+    def test_method_from_device_after_unregister(self):
+        registry.register(SMSMethod())
+        self.assertEqual(registry.method_from_device(PhoneDevice(method='sms')).code, 'sms')
+        registry.unregister('sms')
+        self.assertIs(registry.method_from_device(PhoneDevice(method='sms')), registry.default_method)
+        with self.assertRaises(MethodNotFoundError):
+            registry.get_method('sms')
+
+    def test_can_filter_devices(self):
+        self.assertTrue(GeneratorMethod().can_filter_devices())
+        self.assertTrue(SMSMethod().can_filter_devices())
+        # get_devices may filter the devices further
+        self.assertFalse(ConfirmedGeneratorMethod().can_filter_devices())
+        with mock.patch.object(ConfirmedGeneratorMethod, 'filter_devices', create=True):
+            self.assertTrue(ConfirmedGeneratorMethod().can_filter_devices())
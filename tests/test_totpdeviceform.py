@@ -60,3 +60,15 @@ class TOTPDeviceFormTest(TestCase):
         form = TOTPDeviceForm(TOTPDeviceFormTest.key, None, data={'token': device_totp})
         self.assertFalse(form.is_valid())
         self.assertEqual(form.errors['token'][0], TOTPDeviceForm.error_messages['invalid_token'])
+
+    def test_stored_valid_t0(self, mock_test):
+        # The token matches both t0 = 0 without drift, and the t0 derived
+        # from the stored valid_t0 with a drift of 1
+        metadata = {'valid_t0': TEST_TIME - 30}
+        form = TOTPDeviceForm(TOTPDeviceFormTest.key, None, metadata=metadata,
+                              data={'token': self.totp_with_offset(0)})
+        with patch('two_factor.forms.time', return_value=TEST_TIME):
+            self.assertTrue(form.is_valid())
+        self.assertEqual(metadata['valid_t0'], TEST_TIME - 30)
+        self.assertEqual(form.drift, 1)
+        self.assertEqual(form.t, TEST_TIME // 30)
@@ -1,9 +1,12 @@
 import string
+from inspect import signature
 from unittest import mock
 from urllib.parse import parse_qsl, urlparse
 
 from django.contrib.auth.hashers import make_password
+from django.core.signing import BadSignature
 from django.test import TestCase, override_settings
+from django_otp.oath import totp
 from django_otp.util import random_hex
 from phonenumber_field.phonenumber import PhoneNumber
 
@@ -16,11 +19,13 @@ from two_factor.plugins.phonenumber.utils import (
 )
 from two_factor.plugins.registry import GeneratorMethod, MethodRegistry
 from two_factor.utils import (
-    USER_DEFAULT_DEVICE_ATTR_NAME, default_device, get_otpauth_url,
-    totp_digits,
+    USER_DEFAULT_DEVICE_ATTR_NAME, accepts_parameter, default_device,
+    get_otpauth_url, match_totp, totp_digits,
 )
 from two_factor.views.utils import (
-    get_remember_device_cookie, validate_remember_device_cookie,
+    dump_remember_device_cookies, get_remember_device_cookie,
+    get_remember_device_cookie_key, hash_remember_device_cookie_key,
+    load_remember_device_cookies, validate_remember_device_cookie,
 )
 
 from .utils import UserMixin
@@ -150,6 +155,78 @@ class UtilsTest(UserMixin, TestCase):
         )
         self.assertTrue(all(c in allowed_characters for c in cookie_value))
 
+    def test_get_remember_device_cookie_key(self):
+        user = mock.Mock()
+        user.pk = 123
+        user.password = make_password("xx")
+
+        cookie_value = get_remember_device_cookie(
+            user=user, otp_device_id="SomeModel/33"
+        )
+        self.assertEqual(get_remember_device_cookie_key(cookie_value),
+                         hash_remember_device_cookie_key("SomeModel/33"))
+        self.assertIsNone(get_remember_device_cookie_key("malformed"))
+
+    def test_dump_and_load_remember_device_cookies(self):
+        user = mock.Mock()
+        user.pk = 123
+        user.password = make_password("xx")
+        allowed_characters = set(string.ascii_letters + string.digits + "-_:.")
+
+        cookies = [get_remember_device_cookie(user=user, otp_device_id="SomeModel/%d" % i) for i in range(3)]
+        value = dump_remember_device_cookies(cookies)
+        self.assertTrue(all(c in allowed_characters for c in value))
+        self.assertEqual(load_remember_device_cookies(value), cookies)
+        self.assertEqual(load_remember_device_cookies(dump_remember_device_cookies([])), [])
+        with self.assertRaises(BadSignature):
+            load_remember_device_cookies(value[:-1])
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_MAX_ENTRIES=100)
+    def test_dump_remember_device_cookies_size(self):
+        user = mock.Mock()
+        user.pk = 123
+        user.password = make_password("xx")
+
+        cookies = [get_remember_device_cookie(user=user, otp_device_id="SomeModel/%d" % i) for i in range(100)]
+        value = dump_remember_device_cookies(cookies)
+        self.assertLessEqual(len(value), 3800)
+        loaded = load_remember_device_cookies(value)
+        self.assertEqual(loaded, cookies[:len(loaded)])
+
+    @mock.patch('django_otp.oath.time', return_value=1641194517)
+    def test_match_totp(self, mock_time):
+        key = bytes.fromhex(random_hex())
+        for digits in (6, 8):
+            for window in (0, 1, 5):
+                drifts = range(-window, window + 1)
+                for drift in drifts:
+                    token = totp(key, drift=drift, digits=digits)
+                    self.assertEqual(match_totp(key, token, drifts=drifts, digits=digits), (0, drift))
+                token = totp(key, drift=window + 1, digits=digits)
+                self.assertIsNone(match_totp(key, token, drifts=drifts, digits=digits))
+
+        # The first matching t0 is returned
+        token = totp(key, t0=0)
+        self.assertEqual(match_totp(key, token, t0s=(0, 5)), (0, 0))
+        self.assertEqual(match_totp(key, token, t0s=(-300, 0)), (0, 0))
+
+    def test_accepts_parameter(self):
+        class Form:
+            def __init__(self, user, **kwargs):
+                pass
+
+        class Device:
+            def generate_challenge(self, extra_context=None):
+                pass
+
+        with mock.patch('two_factor.utils.signature', wraps=signature) as signature_mock:
+            for i in range(3):
+                self.assertTrue(accepts_parameter(Form, 'user'))
+                self.assertFalse(accepts_parameter(Form, 'request'))
+                self.assertTrue(accepts_parameter(Device().generate_challenge, 'extra_context'))
+            # Introspected once per class or function, not per call
+            self.assertEqual(signature_mock.call_count, 2)
+
 
 class PhoneUtilsTests(UserMixin, TestCase):
     def test_get_available_phone_methods(self):
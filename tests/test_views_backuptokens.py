@@ -1,5 +1,17 @@
-from django.test import TestCase
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django_otp.plugins.otp_static.models import StaticDevice, StaticToken
+
+from two_factor.backup_tokens import (
+    count_backup_tokens, generate_backup_tokens, hash_static_tokens,
+    iter_regenerate_backup_tokens, random_backup_tokens,
+    regenerate_backup_tokens, verify_backup_token,
+)
+from two_factor.models import BackupToken
 
 from .utils import UserMixin
 
@@ -14,6 +26,8 @@ class BackupTokensTest(UserMixin, TestCase):
     def test_empty(self):
         response = self.client.get(reverse('two_factor:backup_tokens'))
         self.assertContains(response, 'You don\'t have any backup codes yet.')
+        # Viewing the page doesn't create the backup device
+        self.assertFalse(StaticDevice.objects.exists())
 
     def test_generate(self):
         url = reverse('two_factor:backup_tokens')
@@ -34,3 +48,115 @@ class BackupTokensTest(UserMixin, TestCase):
         second_set = set([token.token for token in
                          response.context_data['device'].token_set.all()])
         self.assertNotEqual(first_set, second_set)
+
+    @override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_generate_hashed(self):
+        url = reverse('two_factor:backup_tokens')
+        response = self.client.post(url)
+        self.assertFalse(StaticToken.objects.exists())
+        self.assertEqual(BackupToken.objects.count(), 10)
+        # The tokens are shown once, in the response, and aren't stored
+        tokens = response.context_data['new_tokens']
+        self.assertFalse(any(token in str(dict(self.client.session)) for token in tokens))
+        self.assertEqual(len(tokens), 10)
+        for token in tokens:
+            self.assertContains(response, '<li>%s</li>' % token)
+            self.assertFalse(BackupToken.objects.filter(token_hash__contains=token).exists())
+        response = self.client.get(url)
+        self.assertIsNone(response.context_data['new_tokens'])
+        self.assertNotContains(response, tokens[0])
+        self.assertContains(response, 'You have 10 backup tokens left.')
+
+    @override_settings(TWO_FACTOR_BACKUP_TOKEN_COUNT=5, TWO_FACTOR_BACKUP_TOKEN_LENGTH=12)
+    def test_generate_settings(self):
+        self.client.post(reverse('two_factor:backup_tokens'))
+        tokens = StaticToken.objects.values_list('token', flat=True)
+        self.assertEqual(len(tokens), 5)
+        self.assertEqual({len(token) for token in tokens}, {12})
+
+
+class BackupTokenServiceTest(UserMixin, TestCase):
+    def test_generate_backup_tokens(self):
+        device = self.create_user().staticdevice_set.create(name='backup')
+        device.token_set.create(token='abcdef123')
+        # Delete the plaintext and hashed tokens and insert the new ones,
+        # within a savepoint
+        with self.assertNumQueries(5):
+            tokens = generate_backup_tokens(device)
+        self.assertEqual(len(tokens), 10)
+        self.assertEqual(set(device.token_set.values_list('token', flat=True)), set(tokens))
+
+    def test_random_backup_tokens(self):
+        tokens = random_backup_tokens(32, 1)
+        self.assertEqual(sorted(tokens), sorted('abcdefghijklmnopqrstuvwxyz234567'))
+        with self.assertRaisesMessage(ValueError, 'Cannot generate 33 distinct backup tokens of 1 characters.'):
+            random_backup_tokens(33, 1)
+
+    def test_regenerate_backup_tokens(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(5)]
+        users[0].staticdevice_set.create(name='backup').token_set.create(token='abcdef123')
+        users[1].staticdevice_set.create(name='alter')
+        users[1].staticdevice_set.create(name='backup')
+
+        # The users, then two batches with a constant number of queries
+        with self.assertNumQueries(1 + 2 * 8):
+            tokens = regenerate_backup_tokens(self.User.objects.all(), number=3, batch_size=3)
+        self.assertEqual(set(tokens), {user.pk for user in users})
+        for user in users:
+            device = user.staticdevice_set.order_by('pk').first()
+            self.assertEqual(set(device.token_set.values_list('token', flat=True)), set(tokens[user.pk]))
+            self.assertEqual(len(tokens[user.pk]), 3)
+        self.assertFalse(StaticToken.objects.filter(token='abcdef123').exists())
+        self.assertEqual(StaticDevice.objects.count(), 6)
+
+    def test_iter_regenerate_backup_tokens(self):
+        users = [self.create_user('user%d@example.com' % i) for i in range(3)]
+        tokens = iter_regenerate_backup_tokens(users, batch_size=2)
+        self.assertFalse(StaticDevice.objects.exists())
+        user_id, user_tokens = next(tokens)
+        self.assertEqual(user_id, users[0].pk)
+        self.assertEqual(StaticDevice.objects.count(), 2)
+        self.assertEqual(len(dict(tokens)), 2)
+        self.assertEqual(StaticToken.objects.count(), 30)
+
+    @override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_verify_backup_token(self):
+        device = self.create_user().staticdevice_set.create(name='backup')
+        device.token_set.create(token='abcdef123')
+        token = generate_backup_tokens(device)[0]
+        device.token_set.create(token='abcdef123')
+
+        self.assertTrue(verify_backup_token(device, token))
+        self.assertFalse(verify_backup_token(device, token))
+        device.throttle_reset()
+        # Plaintext tokens still work
+        self.assertTrue(verify_backup_token(device, 'abcdef123'))
+        self.assertEqual(count_backup_tokens([device]), 9)
+
+    def test_verify_backup_token_with_secret_key_fallback(self):
+        device = self.create_user().staticdevice_set.create(name='backup')
+        with override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True, SECRET_KEY='old-secret'):
+            token = generate_backup_tokens(device)[0]
+        with override_settings(SECRET_KEY_FALLBACKS=['old-secret']):
+            self.assertTrue(verify_backup_token(device, token))
+
+    def test_hash_static_tokens(self):
+        devices = [self.create_user('user%d@example.com' % i).staticdevice_set.create(name='backup')
+                   for i in range(2)]
+        tokens = [generate_backup_tokens(device) for device in devices]
+
+        hash_static_tokens(devices[:1])
+        self.assertFalse(devices[0].token_set.exists())
+        self.assertEqual(devices[1].token_set.count(), 10)
+        self.assertTrue(verify_backup_token(devices[0], tokens[0][0]))
+
+        # The command does the same for all devices, when hashing is enabled
+        with self.assertRaisesMessage(CommandError, 'Enable the TWO_FACTOR_HASH_BACKUP_TOKENS setting first'):
+            call_command('two_factor_hash_backup_tokens', stdout=StringIO())
+        self.assertEqual(devices[1].token_set.count(), 10)
+        stdout = StringIO()
+        with override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True):
+            call_command('two_factor_hash_backup_tokens', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Hashed 10 backup tokens\n')
+        self.assertFalse(devices[1].token_set.exists())
+        self.assertTrue(verify_backup_token(devices[1], tokens[1][0]))
@@ -1,20 +1,38 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
+from threading import Barrier, Event, Thread
 from time import sleep
 from unittest import mock, skipUnless
 
 from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import signing
+from django.core.cache import cache
 from django.core.signing import BadSignature
+from django.db import connection
 from django.shortcuts import resolve_url
-from django.test import RequestFactory, TestCase
-from django.test.utils import modify_settings, override_settings
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import (
+    CaptureQueriesContext, modify_settings, override_settings,
+)
 from django.urls import reverse
-from django_otp import DEVICE_ID_SESSION_KEY
+from django_otp import DEVICE_ID_SESSION_KEY, device_classes
 from django_otp.oath import totp
+from django_otp.plugins.otp_totp.models import TOTPDevice
 from django_otp.util import random_hex
 from freezegun import freeze_time
 
+from two_factor.backup_tokens import generate_backup_tokens
+from two_factor.challenges import ThreadPoolChallengeDispatcher
+from two_factor.models import RememberDeviceToken
+from two_factor.plugins.phonenumber.method import PhoneMethodBase
 from two_factor.views.core import LoginView
+from two_factor.views.utils import (
+    LoginCookieStorage, dump_remember_device_cookies,
+    get_remember_device_cookie, get_remember_device_cookie_key,
+    load_remember_device_cookies, validate_remember_device_cookie,
+)
 
 from .utils import UserMixin, totp_str
 
@@ -295,6 +313,44 @@ class LoginTest(UserMixin, TestCase):
                                    'login_view-current_step': 'token'})
             self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
 
+    @override_settings(TWO_FACTOR_TOTP_REPLAY_CACHE=True)
+    def test_totp_replay_cache(self):
+        user = self.create_user()
+        device = user.totpdevice_set.create(name='default', key=random_hex())
+        self.addCleanup(cache.clear)
+
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        token = totp_str(device.bin_key)
+        with mock.patch.object(TOTPDevice, 'save', autospec=True,
+                               side_effect=TOTPDevice.save) as save:
+            response = self._post({'token-otp_token': token,
+                                   'login_view-current_step': 'token'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+        save.assert_not_called()
+        device.refresh_from_db()
+        self.assertGreater(device.last_t, -1)
+        self.assertIsNotNone(device.last_used_at)
+
+        # The same token can't be used again, although the device wasn't saved
+        self.client.logout()
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        response = self._post({'token-otp_token': token,
+                               'login_view-current_step': 'token'})
+        self.assertContains(response, 'Invalid token.')
+        device.refresh_from_db()
+        self.assertEqual(device.throttling_failure_count, 1)
+
+        # Still rejected by the database once the cache is flushed
+        cache.clear()
+        device.throttle_reset()
+        response = self._post({'token-otp_token': token,
+                               'login_view-current_step': 'token'})
+        self.assertContains(response, 'Invalid token.')
+
     @mock.patch('two_factor.views.core.signals.user_verified.send')
     @override_settings(
         TWO_FACTOR_PHONE_THROTTLE_FACTOR=10,
@@ -388,6 +444,77 @@ class LoginTest(UserMixin, TestCase):
             # Check that the signal was fired.
             mock_signal.assert_called_with(sender=mock.ANY, request=mock.ANY, user=user, device=device)
 
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    @mock.patch('two_factor.gateways.fake.Fake.send_sms')
+    def test_challenge_status(self, send_sms):
+        user = self.create_user()
+        user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertEqual(response.context_data['challenge_status'], 'sent')
+        self.assertEqual(send_sms.call_count, 1)
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    @mock.patch('two_factor.gateways.fake.Fake.send_sms')
+    def test_challenge_hook(self, send_sms):
+        user = self.create_user()
+        device = user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        with mock.patch.object(LoginView, 'generate_challenge_with_context', autospec=True,
+                               side_effect=LoginView.generate_challenge_with_context) as hook:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertEqual(response.context_data['challenge_status'], 'sent')
+        hook.assert_called_once_with(mock.ANY, device)
+        self.assertEqual(send_sms.call_count, 1)
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake',
+                       TWO_FACTOR_CHALLENGE_DEDUPLICATION_WINDOW=60)
+    @mock.patch('two_factor.gateways.fake.Fake.send_sms')
+    def test_challenge_deduplication(self, send_sms):
+        user = self.create_user()
+        device = user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        with freeze_time('2024-01-01 00:00:00') as frozen_time:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+            self.assertEqual(response.context_data['challenge_status'], 'sent')
+
+            # Rendering the token step again doesn't send the same token again
+            frozen_time.tick(10)
+            response = self._post({'challenge_device': device.persistent_id})
+            self.assertContains(response, 'Token:')
+            self.assertEqual(response.context_data['challenge_status'], 'already_sent')
+            self.assertEqual(send_sms.call_count, 1)
+
+            # Sent again once the window has passed
+            frozen_time.tick(60)
+            response = self._post({'challenge_device': device.persistent_id})
+            self.assertEqual(response.context_data['challenge_status'], 'sent')
+            self.assertEqual(send_sms.call_count, 2)
+
+            # Challenges that couldn't be sent can be sent again right away
+            frozen_time.tick(60)
+            send_sms.side_effect = Exception('Gateway error')
+            with self.assertRaises(Exception):
+                self._post({'challenge_device': device.persistent_id})
+            send_sms.side_effect = None
+            response = self._post({'challenge_device': device.persistent_id})
+            self.assertEqual(response.context_data['challenge_status'], 'sent')
+            self.assertEqual(send_sms.call_count, 4)
+
+    @override_settings(TWO_FACTOR_CHALLENGE_DEDUPLICATION_WINDOW=60)
+    def test_challenge_deduplication_without_challenge(self):
+        self.create_user().totpdevice_set.create(name='default', key=random_hex())
+        with mock.patch('two_factor.challenges.cache') as challenge_cache:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        self.assertIsNone(response.context_data['challenge_status'])
+        challenge_cache.add.assert_not_called()
+
     @mock.patch('two_factor.views.core.signals.user_verified.send')
     def test_with_backup_token(self, mock_signal):
         user = self.create_user()
@@ -422,6 +549,34 @@ class LoginTest(UserMixin, TestCase):
         # Check that the signal was fired.
         mock_signal.assert_called_with(sender=mock.ANY, request=mock.ANY, user=user, device=device)
 
+    @override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_with_hashed_backup_token(self):
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+        device = user.staticdevice_set.create(name='backup')
+        token = generate_backup_tokens(device)[0]
+        self.assertFalse(device.token_set.exists())
+
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertEqual(response.context_data['backup_tokens'], 10)
+        self._post({'wizard_goto_step': 'backup'})
+        response = self._post({'backup-otp_token': token,
+                               'login_view-current_step': 'backup'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+        self.assertEqual(device.hashed_token_set.count(), 9)
+
+        # The token was consumed
+        self.client.logout()
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self._post({'wizard_goto_step': 'backup'})
+        response = self._post({'backup-otp_token': token,
+                               'login_view-current_step': 'backup'})
+        self.assertContains(response, 'Invalid token.')
+
     @mock.patch('two_factor.views.core.signals.user_verified.send')
     def test_with_alter_backup_token(self, mock_signal):
         user = self.create_user()
@@ -456,6 +611,22 @@ class LoginTest(UserMixin, TestCase):
         # Check that the signal was fired.
         mock_signal.assert_called_with(sender=mock.ANY, request=mock.ANY, user=user, device=device)
 
+    def test_backup_device_lowest_pk(self):
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+        device = user.staticdevice_set.create(name='backup')
+        device.token_set.create(token='abcdef123')
+        user.staticdevice_set.create(name='alter').token_set.create(token='ghijkl456')
+
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self._post({'wizard_goto_step': 'backup'})
+        response = self._post({'backup-otp_token': 'abcdef123',
+                               'login_view-current_step': 'backup'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+        self.assertEqual(device.persistent_id, self.client.session.get(DEVICE_ID_SESSION_KEY))
+
     def test_totp_token_does_not_impact_backup_token(self):
         """
         Ensures that successfully authenticating with a TOTP token does not
@@ -609,6 +780,40 @@ class LoginTest(UserMixin, TestCase):
 
         self.assertNotIn('secret', session_contents)
 
+    def test_session_saves(self):
+        user = self.create_user()
+        device = user.totpdevice_set.create(name='default', key=random_hex())
+
+        def session_saves():
+            # Creating a session calls save(must_create=True) from save()
+            return len([call for call in save.call_args_list if not call.kwargs.get('must_create')])
+
+        with mock.patch.object(SessionStore, 'save', autospec=True,
+                               side_effect=SessionStore.save) as save:
+            self.client.get(reverse('two_factor:login'))
+            self.assertEqual(session_saves(), 1)
+
+            # Resetting the wizard again leaves the wizard data unchanged
+            self.client.get(reverse('two_factor:login'))
+            self.assertEqual(session_saves(), 1)
+
+            self._post({'auth-username': 'bouke@example.com',
+                        'auth-password': 'secret',
+                        'login_view-current_step': 'auth'})
+            self.assertEqual(session_saves(), 2)
+
+            # So does rendering the token step again
+            response = self._post({'token-otp_token': '123456',
+                                   'login_view-current_step': 'token'})
+            self.assertContains(response, 'Invalid token.')
+            self.assertEqual(session_saves(), 2)
+
+            device.throttle_reset()
+            response = self._post({'token-otp_token': totp_str(device.bin_key),
+                                   'login_view-current_step': 'token'})
+            self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+            self.assertEqual(session_saves(), 3)
+
     def test_login_different_user_with_otp_on_existing_session(self):
         self.create_user()
         vedran_user = self.create_user(username='vedran@example.com')
@@ -649,6 +854,250 @@ class LoginTest(UserMixin, TestCase):
             else:
                 self.assertTrue(login_view.is_step_visible(step, form_class))
 
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    def test_token_step_loads_devices_once(self):
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+        user.phonedevice_set.create(name='backup', number='+31101234567', method='sms')
+        user.staticdevice_set.create(name='backup').token_set.create(token='abcdef123')
+
+        # 2 user lookups (authentication form and wizard storage), 1 query per
+        # device model, 1 backup token count and 4 for saving the session.
+        with self.assertNumQueries(2 + len(list(device_classes())) + 1 + 4):
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        self.assertContains(response, 'Send text message to')
+        self.assertContains(response, 'Use Backup Token')
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    def test_other_devices_without_devices_parameter(self):
+        def get_other_authentication_devices(self, user, main_device):
+            return self.get_devices(user)
+
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+        user.phonedevice_set.create(name='backup', number='+31101234567', method='sms')
+        with mock.patch.object(PhoneMethodBase, 'get_other_authentication_devices',
+                               get_other_authentication_devices):
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Send text message to')
+
+
+@override_settings(
+    TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake',
+    TWO_FACTOR_CHALLENGE_DISPATCHER='two_factor.challenges.ThreadPoolChallengeDispatcher',
+)
+class ThreadPoolChallengeDispatcherTest(UserMixin, TransactionTestCase):
+    # The challenge is generated from another thread, which doesn't see the
+    # data of a TestCase transaction.
+    def setUp(self):
+        super().setUp()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        patcher = mock.patch.object(ThreadPoolChallengeDispatcher, 'executor', executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self, data=None):
+        return self.client.post(reverse('two_factor:login'), data=data)
+
+    @mock.patch('two_factor.challenges.logger')
+    @mock.patch('two_factor.gateways.fake.Fake.send_sms')
+    def test_challenge_status(self, send_sms, logger):
+        user = self.create_user()
+        device = user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+        release, sent = Event(), Event()
+
+        def slow_send_sms(**kwargs):
+            release.wait(5)
+            sent.set()
+        send_sms.side_effect = slow_send_sms
+
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        # The token step is rendered before the text message is sent
+        self.assertContains(response, 'Token:')
+        self.assertEqual(response.context_data['challenge_status'], 'queued')
+        self.assertFalse(sent.is_set())
+        release.set()
+        self.assertTrue(sent.wait(5))
+        # By a device loaded again from the worker
+        self.assertEqual(send_sms.call_args.kwargs['device'], device)
+        self.assertIsNot(send_sms.call_args.kwargs['device'], response.context_data['device'])
+
+        # Failures are logged
+        logged = Event()
+        send_sms.side_effect = Exception('Gateway error')
+        logger.exception.side_effect = lambda *args: logged.set()
+        self.client.get(reverse('two_factor:login'))
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self.assertTrue(logged.wait(5))
+
+    def test_executor_created_once(self):
+        with mock.patch.object(ThreadPoolChallengeDispatcher, 'executor', None):
+            executors = set()
+            barrier = Barrier(4)
+
+            def get_executor():
+                barrier.wait(5)
+                executors.add(ThreadPoolChallengeDispatcher.get_executor())
+            threads = [Thread(target=get_executor) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(executors), 1)
+            executors.pop().shutdown()
+
+
+class LoginCookieStorageTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.device = self.user.totpdevice_set.create(name='default', key=random_hex())
+
+    def login(self, url):
+        self.client.get(reverse(url))
+        response = self.client.post(reverse(url), {'auth-username': 'bouke@example.com',
+                                                   'auth-password': 'secret',
+                                                   'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        response = self.client.post(reverse(url), {'token-otp_token': totp_str(self.device.bin_key),
+                                                   'login_view-current_step': 'token'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+        return response
+
+    def count_session_writes(self, url):
+        with CaptureQueriesContext(connection) as context:
+            self.login(url)
+        return len([query for query in context.captured_queries
+                    if 'django_session' in query['sql']
+                    and query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))])
+
+    def test_login(self):
+        response = self.login('cookie-storage-login')
+        self.assertEqual(self.device.persistent_id,
+                         self.client.session.get(DEVICE_ID_SESSION_KEY))
+        self.assertEqual(response.cookies['wizard_login_view'].value, '')
+
+    def test_no_session_before_login(self):
+        self.client.post(reverse('cookie-storage-login'), {'auth-username': 'bouke@example.com',
+                                                           'auth-password': 'secret',
+                                                           'login_view-current_step': 'auth'})
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        # Readable by the client, without the password or any step data
+        data = signing.loads(self.client.cookies['wizard_login_view'].value,
+                             salt=LoginCookieStorage.cookie_salt)
+        self.assertEqual(set(data), {'user_pk', 'user_backend', 'authentication_time', 'step'})
+        self.assertEqual(data['user_pk'], str(self.user.pk))
+        self.assertEqual(data['step'], 'token')
+
+    def test_tampered_cookie(self):
+        self.client.post(reverse('cookie-storage-login'), {'auth-username': 'bouke@example.com',
+                                                           'auth-password': 'secret',
+                                                           'login_view-current_step': 'auth'})
+        self.client.cookies['wizard_login_view'] = self.client.cookies['wizard_login_view'].value + 'x'
+        response = self.client.post(reverse('cookie-storage-login'),
+                                    {'token-otp_token': totp_str(self.device.bin_key),
+                                     'login_view-current_step': 'token'})
+        self.assertContains(response, 'Password:')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+    @mock.patch('two_factor.views.core.time')
+    def test_expired(self, mock_time):
+        mock_time.time.return_value = 12345.12
+        self.client.post(reverse('cookie-storage-login'), {'auth-username': 'bouke@example.com',
+                                                           'auth-password': 'secret',
+                                                           'login_view-current_step': 'auth'})
+        mock_time.time.return_value = 12345.12 + 601
+        response = self.client.post(reverse('cookie-storage-login'),
+                                    {'token-otp_token': totp_str(self.device.bin_key),
+                                     'login_view-current_step': 'token'})
+        self.assertContains(response, 'Password:')
+        self.assertContains(response, 'Your session has timed out. Please login again.')
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_session_writes_per_login(self):
+        # The session storage saves the session on each step of the wizard,
+        # whereas the cookie storage only writes it when login() creates the
+        # session and when it is saved at the end of that request.
+        session_writes = self.count_session_writes('two_factor:login')
+        self.client.logout()
+        # allow the same token to be used again
+        self.user.totpdevice_set.update(last_t=-1)
+        cookie_writes = self.count_session_writes('cookie-storage-login')
+        self.assertLess(cookie_writes, session_writes)
+        self.assertEqual(cookie_writes, 2)
+
+
+class AsyncLoginViewTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+
+    async def _post(self, data):
+        return await self.async_client.post(reverse('async-login'), data=data)
+
+    async def test_with_generator(self):
+        device = await self.user.totpdevice_set.acreate(name='default', key=random_hex())
+        response = await self._post({'auth-username': 'bouke@example.com',
+                                     'auth-password': 'secret',
+                                     'async_login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+
+        response = await self._post({'token-otp_token': totp_str(device.bin_key),
+                                     'async_login_view-current_step': 'token'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL),
+                             fetch_redirect_response=False)
+        session = await self.async_client.asession()
+        self.assertEqual(device.persistent_id, await session.aget(DEVICE_ID_SESSION_KEY))
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    @mock.patch('two_factor.gateways.fake.Fake.send_sms')
+    @mock.patch('two_factor.gateways.fake.Fake.asend_sms', new_callable=mock.AsyncMock)
+    async def test_awaits_gateway(self, asend_sms, send_sms):
+        device = await self.user.phonedevice_set.acreate(name='default', number='+31101234567',
+                                                         method='sms')
+        response = await self._post({'auth-username': 'bouke@example.com',
+                                     'auth-password': 'secret',
+                                     'async_login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        asend_sms.assert_awaited_once_with(device=device, token=mock.ANY)
+        self.assertFalse(send_sms.called)
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    @mock.patch('two_factor.gateways.fake.Fake.send_sms')
+    async def test_sync_challenge_hook(self, send_sms):
+        device = await self.user.phonedevice_set.acreate(name='default', number='+31101234567',
+                                                         method='sms')
+        with mock.patch.object(LoginView, 'generate_challenge_with_context', autospec=True,
+                               side_effect=LoginView.generate_challenge_with_context) as hook:
+            response = await self._post({'auth-username': 'bouke@example.com',
+                                         'auth-password': 'secret',
+                                         'async_login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        hook.assert_called_once_with(mock.ANY, device)
+        self.assertEqual(send_sms.call_count, 1)
+
+    async def test_invalid_login(self):
+        response = await self._post({'auth-username': 'bouke@example.com',
+                                     'auth-password': 'wrong',
+                                     'async_login_view-current_step': 'auth'})
+        self.assertContains(response, 'Please enter a correct')
+
+    async def test_method_not_allowed(self):
+        response = await self.async_client.options(reverse('async-login'))
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.put(reverse('async-login'))
+        self.assertEqual(response.status_code, 405)
+
 
 class BackupTokensTest(UserMixin, TestCase):
     def setUp(self):
@@ -900,6 +1349,142 @@ class RememberLoginTest(UserMixin, TestCase):
                                'login_view-current_step': 'auth'})
         self.assertRedirects(response, reverse(settings.LOGIN_REDIRECT_URL), fetch_redirect_response=False)
 
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60, TWO_FACTOR_REMEMBER_COOKIE_REGISTRY=True)
+    def test_with_remember_registry(self):
+        cache.clear()
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        response = self._post({'token-otp_token': totp_str(self.device.bin_key),
+                               'login_view-current_step': 'token',
+                               'token-remember': 'on'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertEqual(RememberDeviceToken.objects.filter(user=self.user).count(), 1)
+        self.client.post(reverse('logout'))
+
+        # Remembered browser
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.client.post(reverse('logout'))
+
+        # Once revoked, the token is asked again and the cookie removed
+        RememberDeviceToken.objects.filter(user=self.user).revoke()
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        self.assertFalse(any(
+            key.startswith('remember-cookie_') and cookie.value
+            for key, cookie in self.client.cookies.items()
+        ))
+
+    def login_with_remember(self):
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        response = self._post({'token-otp_token': totp_str(self.device.bin_key),
+                               'login_view-current_step': 'token',
+                               'token-remember': 'on'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.client.post(reverse('logout'))
+        return response
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60, TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATE=True)
+    def test_consolidated_remember_cookie(self):
+        response = self.login_with_remember()
+        self.assertEqual(0, len([cookie for cookie in response.cookies if cookie.startswith('remember-cookie_')]))
+        self.assertEqual(len(load_remember_device_cookies(response.cookies['remember-cookies'].value)), 1)
+
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        # The single entry is already the most recent one, the cookie is left untouched
+        self.assertNotIn('remember-cookies', response.cookies)
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+    def test_consolidated_remember_cookie_migration(self):
+        response = self.login_with_remember()
+        legacy_key, = [cookie for cookie in response.cookies if cookie.startswith('remember-cookie_')]
+        legacy_value = response.cookies[legacy_key].value
+
+        with self.settings(TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATE=True):
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertEqual(response.cookies[legacy_key].value, '')
+        self.assertEqual(load_remember_device_cookies(response.cookies['remember-cookies'].value), [legacy_value])
+
+    @override_settings(
+        TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60,
+        TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATE=True,
+        TWO_FACTOR_REMEMBER_COOKIE_MAX_ENTRIES=3,
+    )
+    def test_consolidated_remember_cookie_lru(self):
+        other_cookies = [
+            get_remember_device_cookie(user=self.user, otp_device_id='otp_totp.totpdevice/%d' % (1000 + i))
+            for i in range(5)
+        ]
+        self.client.cookies['remember-cookies'] = dump_remember_device_cookies(other_cookies)
+        self.assertEqual(len(load_remember_device_cookies(self.client.cookies['remember-cookies'].value)), 3)
+
+        response = self.login_with_remember()
+        entries = load_remember_device_cookies(response.cookies['remember-cookies'].value)
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(get_remember_device_cookie_key(entries[0]),
+                         get_remember_device_cookie_key(
+                             get_remember_device_cookie(user=self.user, otp_device_id=self.device.persistent_id)))
+        self.assertEqual(entries[1:], other_cookies[:2])
+
+        # Using a remembered entry moves it first
+        self.client.cookies['remember-cookies'] = dump_remember_device_cookies(entries[1:] + entries[:1])
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertEqual(load_remember_device_cookies(response.cookies['remember-cookies'].value), entries)
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60, TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATE=True)
+    def test_consolidated_remember_cookie_tampered(self):
+        response = self.login_with_remember()
+        self.client.cookies['remember-cookies'] = response.cookies['remember-cookies'].value + 'x'
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        self.assertEqual(response.cookies['remember-cookies'].value, '')
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+    def test_remember_cookies_of_other_users(self):
+        # Cookies left in a shared browser by other accounts are matched on
+        # their device hash and never validated against this user's devices.
+        for i in range(20):
+            other_device_id = 'otp_totp.totpdevice/%d' % (1000 + i)
+            self.client.cookies['remember-cookie_other%d' % i] = get_remember_device_cookie(
+                user=self.user, otp_device_id=other_device_id)
+        self.client.cookies['remember-cookie_malformed'] = 'malformed'
+
+        with mock.patch('two_factor.views.core.validate_remember_device_cookie') as validate_mock:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        validate_mock.assert_not_called()
+
+        self.client.cookies['remember-cookie_mine'] = get_remember_device_cookie(
+            user=self.user, otp_device_id=self.device.persistent_id)
+        self.client.get(reverse('two_factor:login'))
+        with mock.patch('two_factor.views.core.validate_remember_device_cookie',
+                        wraps=validate_remember_device_cookie) as validate_mock:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse(settings.LOGIN_REDIRECT_URL), fetch_redirect_response=False)
+        self.assertEqual(validate_mock.call_count, 1)
+
     @mock.patch('two_factor.gateways.fake.Fake')
     @mock.patch('two_factor.views.core.signals.user_verified.send')
     @override_settings(
@@ -947,11 +1532,11 @@ class RememberLoginTest(UserMixin, TestCase):
                                'token-remember': 'on'})
         self.client.post(reverse('logout'))
 
-        # mock device_for_user
-        with mock.patch("two_factor.views.core.devices_for_user") as devices_for_user_mock, \
+        # mock the confirmed devices of the user
+        with mock.patch("two_factor.utils.DeviceSnapshot.confirmed") as devices_for_user_mock, \
                 mock.patch("two_factor.views.core.validate_remember_device_cookie") as validate_mock:
             device_mock = mock.Mock(spec=["verify_is_allowed", "persistent_id", "user_id"])
-            device_mock.persistent_id = 1
+            device_mock.persistent_id = self.device.persistent_id
             device_mock.verify_is_allowed.return_value = [True, {}]
             devices_for_user_mock.return_value = [device_mock]
             validate_mock.return_value = True
@@ -1,7 +1,8 @@
 from unittest import mock
 
 import qrcode.image.svg
-from django.test import RequestFactory, TestCase
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
 
 from two_factor.utils import get_otpauth_url
@@ -23,6 +24,7 @@ class QRTest(UserMixin, TestCase):
         super().setUp()
         self.user = self.create_user(username='ⓑỚ𝓾⒦ȩ')
         self.login_user()
+        cache.clear()
 
     def test_without_secret(self):
         response = self.client.get(reverse('two_factor:qr'))
@@ -91,3 +93,44 @@ class QRTest(UserMixin, TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content.decode('utf-8'), self.test_img)
         self.assertEqual(response['Content-Type'], 'image/svg+xml; charset=utf-8')
+
+    def set_secret(self):
+        session = self.client.session
+        session['django_two_factor-qr_secret_key'] = self.test_secret
+        session.save()
+
+    def test_etag(self):
+        self.set_secret()
+        response = self.client.get(reverse('two_factor:qr'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('no-store', response['Cache-Control'])
+        etag = response['ETag']
+
+        with mock.patch('qrcode.make') as mockqrcode:
+            response = self.client.get(reverse('two_factor:qr'), headers={'if-none-match': etag})
+        mockqrcode.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # Another secret makes another image
+        session = self.client.session
+        session['django_two_factor-qr_secret_key'] = 'Another secret'
+        session.save()
+        response = self.client.get(reverse('two_factor:qr'), headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_render_cache(self):
+        self.set_secret()
+        content = self.client.get(reverse('two_factor:qr')).content
+        with mock.patch('qrcode.make') as mockqrcode:
+            response = self.client.get(reverse('two_factor:qr'))
+        mockqrcode.assert_not_called()
+        self.assertEqual(response.content, content)
+
+        with override_settings(TWO_FACTOR_QR_CACHE_TIMEOUT=0), mock.patch('qrcode.make') as mockqrcode:
+            mockqrcode.return_value.save.side_effect = lambda resp: resp.write(self.test_img)
+            response = self.client.get(reverse('two_factor:qr'))
+        mockqrcode.assert_called_once()
+        self.assertEqual(response.content.decode(), self.test_img)
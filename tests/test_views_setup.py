@@ -1,4 +1,4 @@
-from base64 import b32decode
+from base64 import b32decode, b64decode
 from binascii import unhexlify
 from unittest import mock
 
@@ -8,6 +8,8 @@ from django.urls import reverse
 from django_otp import DEVICE_ID_SESSION_KEY
 from django_otp.oath import totp
 
+from two_factor.views.core import SetupView
+
 from .utils import UserMixin, method_registry
 
 
@@ -124,6 +126,44 @@ class SetupTest(UserMixin, TestCase):
         response = self.client.post(custom_setup, data=data)
         self.assertRedirects(response, custom_redirect)
 
+    @method_registry(['generator'])
+    @override_settings(TWO_FACTOR_QR_INLINE=True)
+    def test_setup_generator_inline_qr_code(self):
+        response = self.client.post(
+            reverse('two_factor:setup'),
+            data={'setup_view-current_step': 'welcome'})
+        qr_url = response.context_data['QR_URL']
+        self.assertTrue(qr_url.startswith('data:image/svg+xml;charset=utf-8;base64,'))
+        self.assertContains(response, '<img src="%s"' % qr_url)
+        self.assertIn(b'<svg', b64decode(qr_url.split(',', 1)[1]))
+        self.assertNotIn('django_two_factor-qr_secret_key', self.client.session.keys())
+
+        key = response.context_data['keys'].get('generator')
+        response = self.client.post(
+            reverse('two_factor:setup'),
+            data={'setup_view-current_step': 'generator',
+                  'generator-token': totp(unhexlify(key.encode()))})
+        self.assertRedirects(response, reverse('two_factor:setup_complete'))
+
+    def test_form_list_computed_once_per_method(self):
+        with mock.patch.object(SetupView, 'compute_form_list', autospec=True,
+                               side_effect=SetupView.compute_form_list) as compute_form_list:
+            self._post(data={'setup_view-current_step': 'welcome'})
+            self.assertEqual(compute_form_list.call_count, 1)
+
+            # Once with the previous method, once with the selected one
+            compute_form_list.reset_mock()
+            response = self._post(data={'setup_view-current_step': 'method',
+                                        'method-method': 'generator'})
+            self.assertEqual(compute_form_list.call_count, 2)
+
+            compute_form_list.reset_mock()
+            key = response.context_data['keys'].get('generator')
+            response = self._post(data={'setup_view-current_step': 'generator',
+                                        'generator-token': totp(unhexlify(key.encode()))})
+            self.assertRedirects(response, reverse('two_factor:setup_complete'))
+            self.assertEqual(compute_form_list.call_count, 1)
+
     def _post(self, data):
         return self.client.post(reverse('two_factor:setup'), data=data)
 
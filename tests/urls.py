@@ -3,7 +3,7 @@ from django.urls import include, path
 
 from two_factor.gateways.twilio.urls import urlpatterns as tf_twilio_urls
 from two_factor.urls import urlpatterns as tf_urls
-from two_factor.views import LoginView, SetupView
+from two_factor.views import AsyncLoginView, LoginView, SetupView
 
 from .views import LoginViewWithContext, SecureView, plain_view
 
@@ -37,6 +37,16 @@ urlpatterns = [
         ),
         name='custom-redirect-authenticated-user-login',
     ),
+    path(
+        'account/async-login/',
+        AsyncLoginView.as_view(),
+        name='async-login',
+    ),
+    path(
+        'account/cookie-storage-login/',
+        LoginView.as_view(storage_name='two_factor.views.utils.LoginCookieStorage'),
+        name='cookie-storage-login',
+    ),
     path(
         'account/custom-device-context-login/',
         LoginViewWithContext.as_view(),
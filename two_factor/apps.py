@@ -5,6 +5,7 @@ from django.conf import settings
 class TwoFactorConfig(AppConfig):
     name = 'two_factor'
     verbose_name = "Django Two Factor Authentication"
+    default_auto_field = "django.db.models.AutoField"
 
     def ready(self):
         from . import checks  # noqa
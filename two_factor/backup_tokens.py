@@ -0,0 +1,183 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.crypto import get_random_string, salted_hmac
+from django_otp.plugins.otp_static.models import StaticDevice, StaticToken
+
+from .models import BackupToken, backup_token_hashing_enabled
+
+# Same alphabet as StaticToken.random_token()
+BACKUP_TOKEN_CHARS = 'abcdefghijklmnopqrstuvwxyz234567'
+
+
+def backup_token_count():
+    return getattr(settings, 'TWO_FACTOR_BACKUP_TOKEN_COUNT', 10)
+
+
+def backup_token_length():
+    return getattr(settings, 'TWO_FACTOR_BACKUP_TOKEN_LENGTH', 8)
+
+
+def backup_token_space(length):
+    """
+    Returns the number of possible backup tokens of `length` characters.
+    """
+    return len(BACKUP_TOKEN_CHARS) ** length
+
+
+def random_backup_tokens(number=None, length=None):
+    number = backup_token_count() if number is None else number
+    length = backup_token_length() if length is None else length
+    if number > backup_token_space(length):
+        raise ValueError('Cannot generate %d distinct backup tokens of %d characters.' % (number, length))
+    tokens = set()
+    while len(tokens) < number:
+        tokens.add(get_random_string(length, BACKUP_TOKEN_CHARS))
+    return list(tokens)
+
+
+def hash_backup_token(token, secret=None):
+    return salted_hmac('two_factor.backup_tokens', token, secret=secret, algorithm='sha256').hexdigest()
+
+
+def backup_token_hashes(token):
+    """
+    Returns the hashes `token` may have been stored with, with the current
+    ``SECRET_KEY`` and with each of the ``SECRET_KEY_FALLBACKS``.
+    """
+    secrets = [settings.SECRET_KEY, *getattr(settings, 'SECRET_KEY_FALLBACKS', [])]
+    return [hash_backup_token(token, secret) for secret in secrets]
+
+
+def create_backup_tokens(device_tokens):
+    """
+    Saves the ``(device, token)`` pairs of `device_tokens` with a single bulk
+    insert, hashed if the ``TWO_FACTOR_HASH_BACKUP_TOKENS`` setting is enabled.
+    """
+    if backup_token_hashing_enabled():
+        BackupToken.objects.bulk_create([BackupToken(device=device, token_hash=hash_backup_token(token))
+                                         for device, token in device_tokens])
+    else:
+        StaticToken.objects.bulk_create([StaticToken(device=device, token=token)
+                                         for device, token in device_tokens])
+
+
+def generate_backup_tokens(device, number=None, length=None):
+    """
+    Replaces the tokens of the static `device` with `number` new tokens of
+    `length` characters, in a single transaction. Returns the new tokens.
+    """
+    tokens = random_backup_tokens(number, length)
+    with transaction.atomic():
+        device.token_set.all().delete()
+        BackupToken.objects.filter(device=device).delete()
+        create_backup_tokens((device, token) for token in tokens)
+    return tokens
+
+
+def count_backup_tokens(devices):
+    """
+    Returns the number of backup tokens, hashed or not, of the static `devices`.
+    """
+    if not devices:
+        return 0
+    return StaticToken.objects.filter(device__in=devices).values_list('device_id').union(
+        BackupToken.objects.filter(device__in=devices).values_list('device_id'), all=True,
+    ).count()
+
+
+def verify_backup_token(device, token):
+    """
+    Verifies `token` against the hashed tokens of the static `device`,
+    consuming it with a single DELETE statement, so that concurrent requests
+    can't use the same token twice. Falls back to the plaintext tokens of
+    `StaticDevice.verify_token`.
+    """
+    verify_allowed, _ = device.verify_is_allowed()
+    if not verify_allowed:
+        return False
+
+    deleted, _ = BackupToken.objects.filter(device=device, token_hash__in=backup_token_hashes(token)).delete()
+    if not deleted:
+        # Not device.verify_token, which BackupTokenForm replaces by this function
+        return type(device).verify_token(device, token)
+
+    device.throttle_reset(commit=False)
+    if hasattr(device, 'set_last_used_timestamp'):
+        device.set_last_used_timestamp(commit=False)
+    device.save()
+    return True
+
+
+def hash_static_tokens(devices=None, batch_size=1000):
+    """
+    Moves the plaintext tokens of the static `devices`, or of all static
+    devices, to the hashed store. Use it after enabling the
+    ``TWO_FACTOR_HASH_BACKUP_TOKENS`` setting, the
+    ``two_factor_hash_backup_tokens`` command does it for all devices.
+    """
+    static_tokens = StaticToken.objects.all()
+    if devices is not None:
+        static_tokens = static_tokens.filter(device__in=devices)
+    with transaction.atomic():
+        tokens = static_tokens.values_list('device_id', 'token').iterator()
+        while batch := list(islice(tokens, batch_size)):
+            BackupToken.objects.bulk_create([
+                BackupToken(device_id=device_id, token_hash=hash_backup_token(token))
+                for device_id, token in batch
+            ], ignore_conflicts=True)
+        static_tokens.delete()
+
+
+def regenerate_backup_tokens(users, number=None, length=None, batch_size=500):
+    """
+    Replaces the backup tokens of many `users` (a queryset or an iterable of
+    users or primary keys), e.g. after a breach, creating their backup device
+    if needed. Users are handled in batches of `batch_size`, each in its own
+    transaction and with a constant number of queries.
+
+    Returns a dict mapping the primary keys of the users to their new tokens,
+    so that they can be delivered to the users. To avoid holding the tokens of
+    all users at once, use :func:`iter_regenerate_backup_tokens`.
+    """
+    return dict(iter_regenerate_backup_tokens(users, number, length, batch_size))
+
+
+def iter_regenerate_backup_tokens(users, number=None, length=None, batch_size=500):
+    """
+    Same as :func:`regenerate_backup_tokens`, yielding ``(user_id, tokens)``
+    tuples batch by batch. The tokens of a batch are only replaced once the
+    previous batch has been consumed, nothing happens until it is iterated.
+    """
+    if hasattr(users, 'values_list'):
+        users = users.values_list('pk', flat=True).iterator()
+    batch = []
+    for user in users:
+        batch.append(getattr(user, 'pk', user))
+        if len(batch) == batch_size:
+            yield from _regenerate_backup_tokens(batch, number, length)
+            batch = []
+    if batch:
+        yield from _regenerate_backup_tokens(batch, number, length)
+
+
+def _regenerate_backup_tokens(user_ids, number, length):
+    with transaction.atomic():
+        devices = {}
+        # Like BackupTokensView, use the first static device of each user
+        for device in StaticDevice.objects.filter(user__in=user_ids).order_by('-pk'):
+            devices[device.user_id] = device
+        missing = [StaticDevice(user_id=user_id, name='backup')
+                   for user_id in user_ids if user_id not in devices]
+        if missing:
+            StaticDevice.objects.bulk_create(missing)
+            # Not all databases set the primary keys of bulk created objects
+            for device in StaticDevice.objects.filter(user__in=[device.user_id for device in missing]):
+                devices.setdefault(device.user_id, device)
+
+        StaticToken.objects.filter(device__in=devices.values()).delete()
+        BackupToken.objects.filter(device__in=devices.values()).delete()
+        tokens = {user_id: random_backup_tokens(number, length) for user_id in user_ids}
+        create_backup_tokens((devices[user_id], token) for user_id in user_ids for token in tokens[user_id])
+    return tokens.items()
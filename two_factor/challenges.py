@@ -0,0 +1,118 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+CHALLENGE_SENT = 'sent'
+CHALLENGE_QUEUED = 'queued'
+CHALLENGE_ALREADY_SENT = 'already_sent'
+
+
+def get_challenge_dispatcher():
+    return import_string(getattr(settings, 'TWO_FACTOR_CHALLENGE_DISPATCHER',
+                                 'two_factor.challenges.ChallengeDispatcher'))()
+
+
+def get_challenge_deduplication_window():
+    return getattr(settings, 'TWO_FACTOR_CHALLENGE_DEDUPLICATION_WINDOW', 0)
+
+
+def get_challenge_cache_key(device):
+    return 'two_factor:challenge:%s' % device.persistent_id
+
+
+def challenge_already_sent(device):
+    """
+    Returns True if a challenge was generated for the device within the last
+    ``TWO_FACTOR_CHALLENGE_DEDUPLICATION_WINDOW`` seconds. Otherwise records
+    the challenge and returns False. Challenges that couldn't be sent must be
+    forgotten with :func:`forget_challenge`.
+
+    Always returns False if the setting is ``0``, the default.
+    """
+    window = get_challenge_deduplication_window()
+    if not window:
+        return False
+    return not cache.add(get_challenge_cache_key(device), True, window)
+
+
+def forget_challenge(device):
+    """
+    Forgets the challenge recorded by :func:`challenge_already_sent`, so that
+    it can be sent again.
+    """
+    if get_challenge_deduplication_window():
+        cache.delete(get_challenge_cache_key(device))
+
+
+def generate_challenge(device, extra_context=None):
+    """
+    Calls the `generate_challenge` method of `device`, with `extra_context`
+    unless it is None.
+    """
+    if extra_context is None:
+        return device.generate_challenge()
+    return device.generate_challenge(extra_context)
+
+
+class ChallengeDispatcher:
+    """
+    Generates challenges inline, while handling the request. This is the
+    default dispatcher.
+
+    Dispatchers are set with the ``TWO_FACTOR_CHALLENGE_DISPATCHER`` setting.
+    Their `dispatch` method generates the challenge of `device` for the login
+    `view`, and returns the delivery status, made available as
+    ``challenge_status`` in the context of the token step. This one calls the
+    view's `generate_challenge_with_context` hook.
+    """
+    def dispatch(self, view, device):
+        view.generate_challenge_with_context(device)
+        return CHALLENGE_SENT
+
+
+class ThreadPoolChallengeDispatcher(ChallengeDispatcher):
+    """
+    Generates challenges in a pool of `max_workers` threads, so that the
+    token step is rendered without waiting for the SMS or call gateway.
+
+    The worker only gets the model and primary key of the device, and loads
+    it again, as the challenge is generated outside of the request and its
+    database transaction. For the same reason, the view's
+    `generate_challenge_with_context` hook isn't called: the extra context
+    is taken from its `get_device_context_data` while handling the request.
+    Failures are logged, as the response has been sent already.
+    """
+    max_workers = 4
+    executor = None
+    executor_lock = Lock()
+
+    @classmethod
+    def get_executor(cls):
+        with cls.executor_lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(max_workers=cls.max_workers,
+                                                  thread_name_prefix='two_factor_challenge')
+        return cls.executor
+
+    def dispatch(self, view, device):
+        extra_context = view.get_device_context_data() if view.device_supports_extra_context(device) else None
+        self.get_executor().submit(self.generate_challenge, type(device), device.pk, extra_context)
+        return CHALLENGE_QUEUED
+
+    def generate_challenge(self, model, pk, extra_context):
+        device = model(pk=pk)
+        try:
+            device = model._default_manager.get(pk=pk)
+            generate_challenge(device, extra_context)
+        except Exception:
+            forget_challenge(device)
+            logger.exception('Could not generate a challenge for device %s', device.persistent_id)
+        finally:
+            close_old_connections()
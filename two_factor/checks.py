@@ -9,6 +9,14 @@ MISSING_MSG = "Could not reliably determine where in INSTALLED_APPS two_factor a
 MISSING_HINT = INSTALLED_APPS_HINT
 MISSING_ID = "two_factor.W001"
 
+BACKUP_TOKEN_LENGTH_MSG = "TWO_FACTOR_BACKUP_TOKEN_LENGTH must be an integer between 1 and 16"
+BACKUP_TOKEN_LENGTH_HINT = "Backup tokens are stored in StaticToken.token, at most 16 characters long."
+BACKUP_TOKEN_LENGTH_ID = "two_factor.E002"
+
+BACKUP_TOKEN_COUNT_MSG = "TWO_FACTOR_BACKUP_TOKEN_COUNT must be a positive integer, at most the number of tokens"
+BACKUP_TOKEN_COUNT_HINT = "Lower TWO_FACTOR_BACKUP_TOKEN_COUNT or raise TWO_FACTOR_BACKUP_TOKEN_LENGTH."
+BACKUP_TOKEN_COUNT_ID = "two_factor.E003"
+
 @register()
 def check_installed_app_order(app_configs, **kwargs):
     """Check the order in which two_factor and its plugins are loaded"""
@@ -29,3 +37,28 @@ def check_installed_app_order(app_configs, **kwargs):
         )]
 
     return []
+
+
+@register()
+def check_backup_tokens(app_configs, **kwargs):
+    """Check the length and number of generated backup tokens"""
+    from .backup_tokens import (
+        backup_token_count, backup_token_length, backup_token_space,
+    )
+
+    length = backup_token_length()
+    if type(length) is not int or not 1 <= length <= 16:
+        return [Error(
+            BACKUP_TOKEN_LENGTH_MSG,
+            hint=BACKUP_TOKEN_LENGTH_HINT,
+            id=BACKUP_TOKEN_LENGTH_ID,
+        )]
+    count = backup_token_count()
+    if type(count) is not int or not 1 <= count <= backup_token_space(length):
+        return [Error(
+            BACKUP_TOKEN_COUNT_MSG,
+            hint=BACKUP_TOKEN_COUNT_HINT,
+            id=BACKUP_TOKEN_COUNT_ID,
+        )]
+
+    return []
@@ -1,15 +1,21 @@
 from binascii import unhexlify
+from functools import partial
 from time import time
 
 from django import forms
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
+from django_otp import oath
 from django_otp.forms import OTPAuthenticationFormMixin
-from django_otp.oath import totp
+from django_otp.plugins.otp_static.models import StaticDevice
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
+from .backup_tokens import verify_backup_token
 from .plugins.registry import registry
-from .utils import totp_digits
+from .utils import (
+    accept_totp_time_step, match_totp, totp_digits, totp_replay_cache_enabled,
+    verify_totp_device_token,
+)
 
 
 class MethodForm(forms.Form):
@@ -78,27 +84,32 @@ class TOTPDeviceForm(forms.Form):
 
     def clean_token(self):
         token = self.cleaned_data.get('token')
-        validated = False
         t0s = [self.t0]
-        key = self.bin_key
         if 'valid_t0' in self.metadata:
             t0s.append(int(time()) - self.metadata['valid_t0'])
-        for t0 in t0s:
-            for offset in range(-self.tolerance, self.tolerance + 1):
-                if totp(key, self.step, t0, self.digits, self.drift + offset) == token:
-                    self.drift = offset
-                    self.metadata['valid_t0'] = int(time()) - t0
-                    validated = True
-        if not validated:
+        drifts = range(self.drift - self.tolerance, self.drift + self.tolerance + 1)
+        now = int(oath.time())
+        # In reverse, so that the last matching pair wins as it always did,
+        # keeping the stored valid_t0 when it matches
+        match = token is not None and match_totp(self.bin_key, token, self.step, t0s[::-1], drifts[::-1],
+                                                 self.digits, now=now)
+        if not match:
             raise forms.ValidationError(self.error_messages['invalid_token'])
+        t0, self.drift = match
+        self.metadata['valid_t0'] = int(time()) - t0
+        self.t = (now - t0) // self.step + self.drift
         return token
 
     def save(self):
-        return TOTPDevice.objects.create(user=self.user, key=self.key,
-                                         tolerance=self.tolerance, t0=self.t0,
-                                         step=self.step, drift=self.drift,
-                                         digits=self.digits,
-                                         name='default')
+        device = TOTPDevice.objects.create(user=self.user, key=self.key,
+                                           tolerance=self.tolerance, t0=self.t0,
+                                           step=self.step, drift=self.drift,
+                                           digits=self.digits,
+                                           name='default')
+        if totp_replay_cache_enabled():
+            # The token used to set up the device can't be used to login
+            accept_totp_time_step(device, self.t)
+        return device
 
 
 class DisableForm(forms.Form):
@@ -160,6 +171,16 @@ class AuthenticationTokenForm(OTPAuthenticationFormMixin, forms.Form):
             device = self.initial_device
         return device
 
+    def _verify_token(self, user, token, device=None):
+        if totp_replay_cache_enabled() and isinstance(device, TOTPDevice):
+            # Don't save the device on every verified token
+            device.verify_token = partial(verify_totp_device_token, device)
+            try:
+                return super()._verify_token(user, token, device)
+            finally:
+                del device.verify_token
+        return super()._verify_token(user, token, device)
+
     def clean(self):
         self.clean_otp(self.user)
         return self.cleaned_data
@@ -167,3 +188,13 @@ class AuthenticationTokenForm(OTPAuthenticationFormMixin, forms.Form):
 
 class BackupTokenForm(AuthenticationTokenForm):
     otp_token = forms.CharField(label=_("Token"))
+
+    def _verify_token(self, user, token, device=None):
+        if isinstance(device, StaticDevice):
+            # Also verify the hashed backup tokens
+            device.verify_token = partial(verify_backup_token, device)
+            try:
+                return super()._verify_token(user, token, device)
+            finally:
+                del device.verify_token
+        return super()._verify_token(user, token, device)
@@ -1,3 +1,4 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.utils.module_loading import import_string
 
@@ -14,3 +15,27 @@ def make_call(device, token):
 def send_sms(device, token):
     gateway = get_gateway_class(getattr(settings, 'TWO_FACTOR_SMS_GATEWAY'))()
     gateway.send_sms(device=device, token=token)
+
+
+async def amake_call(device, token):
+    """
+    Async version of make_call, awaiting the gateway's `amake_call` method if
+    it has one, or calling `make_call` in a thread otherwise.
+    """
+    gateway = get_gateway_class(getattr(settings, 'TWO_FACTOR_CALL_GATEWAY'))()
+    if hasattr(gateway, 'amake_call'):
+        await gateway.amake_call(device=device, token=token)
+    else:
+        await sync_to_async(gateway.make_call)(device=device, token=token)
+
+
+async def asend_sms(device, token):
+    """
+    Async version of send_sms, awaiting the gateway's `asend_sms` method if
+    it has one, or calling `send_sms` in a thread otherwise.
+    """
+    gateway = get_gateway_class(getattr(settings, 'TWO_FACTOR_SMS_GATEWAY'))()
+    if hasattr(gateway, 'asend_sms'):
+        await gateway.asend_sms(device=device, token=token)
+    else:
+        await sync_to_async(gateway.send_sms)(device=device, token=token)
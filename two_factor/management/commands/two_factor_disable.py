@@ -1,31 +1,97 @@
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
-from django_otp import devices_for_user
+from django.db import transaction
+from django_otp import device_classes
+
+from ..utils import chunked, get_users_by_username, read_lines
 
 
 class Command(BaseCommand):
     """
     Command for disabling two-factor authentication for certain users.
 
-    The command accepts any number of usernames, and will remove all OTP
-    devices for those users.
+    The command accepts any number of usernames, and will remove all
+    confirmed OTP devices for those users. Unconfirmed devices are left to
+    :class:`two_factor_prune
+    <two_factor.management.commands.two_factor_prune.Command>`.
 
     Example usage::
 
         manage.py two_factor_disable bouke steve
+
+    The users can also be read from a file (one username, or primary key with
+    ``--ids``, per line, ``-`` for the standard input). They are handled in
+    chunks, each in its own transaction, with one ``DELETE`` per device model::
+
+        manage.py two_factor_disable --from-file offboarded.txt --dry-run
+        manage.py two_factor_disable --from-file offboarded.txt
     """
     help = 'Disables two-factor authentication for the given users'
 
     def add_arguments(self, parser):
         parser.add_argument('args', metavar='usernames', nargs='*')
+        parser.add_argument('--from-file', metavar='PATH',
+                            help='Read the users from a file, one per line, or from the '
+                                 'standard input if PATH is "-". Unknown users are '
+                                 'reported on the standard error.')
+        parser.add_argument('--ids', action='store_true',
+                            help='Read primary keys instead of usernames.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the confirmed devices that would be deleted.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of users handled at once.')
 
     def handle(self, *usernames, **options):
+        from_file = options['from_file']
+        if from_file:
+            usernames = read_lines(from_file)
+        user_count = 0
+        device_counts = {}
+        for chunk in chunked(usernames, options['chunk_size']):
+            users = self.get_users(chunk, options['ids'])
+            user_ids = []
+            for key in chunk:
+                if key in users:
+                    user_ids.append(users[key].pk)
+                elif from_file:
+                    self.stderr.write('User "%s" does not exist' % key)
+                else:
+                    raise CommandError('User "%s" does not exist' % key)
+
+            with transaction.atomic():
+                for model in device_classes():
+                    devices = model.objects.filter(user__in=user_ids, confirmed=True)
+                    if options['dry_run']:
+                        count = devices.count()
+                    else:
+                        count = devices.delete()[1].get(model._meta.label, 0)
+                    if count:
+                        device_counts[model._meta.label] = device_counts.get(model._meta.label, 0) + count
+
+            user_count += len(user_ids)
+            if from_file and options['verbosity'] >= 1:
+                self.stdout.write('%d users, %d devices' % (user_count, sum(device_counts.values())))
+
+        if from_file or options['dry_run']:
+            self.stdout.write('%s %d devices of %d users' % (
+                'Would delete' if options['dry_run'] else 'Deleted',
+                sum(device_counts.values()),
+                user_count,
+            ))
+            for label, count in sorted(device_counts.items()):
+                self.stdout.write('  %s: %d' % (label, count))
+
+    def get_users(self, keys, ids):
+        """
+        Returns a dict mapping the given usernames, or primary keys as read
+        from the input, to the matching users.
+        """
+        if not ids:
+            return get_users_by_username(keys)
         User = get_user_model()
-        for username in usernames:
-            try:
-                user = User.objects.get_by_natural_key(username)
-            except User.DoesNotExist:
-                raise CommandError('User "%s" does not exist' % username)
-
-            for device in devices_for_user(user):
-                device.delete()
+        try:
+            users = list(User._default_manager.filter(pk__in=keys))
+        except (ValueError, ValidationError) as exc:
+            raise CommandError('Invalid primary key: %s' % exc)
+        return {str(user.pk): user for user in users}
@@ -0,0 +1,117 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django_otp import device_classes
+from django_otp.plugins.otp_static.models import StaticDevice, StaticToken
+
+from ...models import BackupToken
+from ..utils import chunked, get_fernet, get_users_by_username, read_lines
+
+
+class Command(BaseCommand):
+    """
+    Command exporting the devices of users, to import them in another
+    deployment with :class:`two_factor_import
+    <two_factor.management.commands.two_factor_import.Command>`.
+
+    The devices of all users, of the given users, or of the users listed in a
+    file (one username per line, ``-`` for the standard input) are written as
+    JSON Lines, one line per user with devices. Users are handled in chunks,
+    with one query per device model per chunk.
+
+    The devices, including their secrets and backup tokens, are encrypted with
+    the Fernet key read from ``--key-file``, which requires the
+    ``cryptography`` package (``django-two-factor-auth[export]`` extra). A key
+    can be generated with::
+
+        python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())" > export.key
+
+    Example usage::
+
+        manage.py two_factor_export --all --key-file export.key > devices.jsonl
+        manage.py two_factor_export --from-file moving.txt --key-file export.key > devices.jsonl
+
+    Hashed backup tokens can only be verified by deployments sharing the
+    ``SECRET_KEY``, or having it in their ``SECRET_KEY_FALLBACKS``.
+    """
+    help = 'Exports the devices of the given users as encrypted JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('args', metavar='usernames', nargs='*')
+        parser.add_argument('--all', action='store_true',
+                            help='Export the devices of all users.')
+        parser.add_argument('--from-file', metavar='PATH',
+                            help='Read the usernames from a file, one per line, or from '
+                                 'the standard input if PATH is "-". Unknown usernames '
+                                 'are reported on the standard error.')
+        parser.add_argument('--key-file', required=True,
+                            help='File holding the Fernet key encrypting the devices.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of users loaded at once.')
+
+    def handle(self, *usernames, **options):
+        self.fernet = get_fernet(options['key_file'])
+        chunk_size = options['chunk_size']
+
+        if options['all']:
+            User = get_user_model()
+            users = User._default_manager.order_by('pk').iterator(chunk_size=chunk_size)
+            for chunk in chunked(users, chunk_size):
+                self.export(chunk)
+            return
+
+        if options['from_file']:
+            usernames = read_lines(options['from_file'])
+        for chunk in chunked(usernames, chunk_size):
+            users_by_username = get_users_by_username(chunk)
+            users = []
+            for username in chunk:
+                if username in users_by_username:
+                    users.append(users_by_username[username])
+                elif options['from_file']:
+                    self.stderr.write('User "%s" does not exist' % username)
+                else:
+                    raise CommandError('User "%s" does not exist' % username)
+            self.export(users)
+
+    def export(self, users):
+        devices = {user.pk: [] for user in users}
+        static_devices = {}
+        for model in device_classes():
+            for device in model.objects.filter(user__in=list(devices)).order_by('pk'):
+                data = serialize_device(device)
+                if isinstance(device, StaticDevice):
+                    data['tokens'] = []
+                    data['token_hashes'] = []
+                    static_devices[device.pk] = data
+                devices[device.user_id].append(data)
+
+        if static_devices:
+            for device_id, token in StaticToken.objects.filter(
+                    device__in=list(static_devices)).values_list('device_id', 'token'):
+                static_devices[device_id]['tokens'].append(token)
+            for device_id, token_hash in BackupToken.objects.filter(
+                    device__in=list(static_devices)).values_list('device_id', 'token_hash'):
+                static_devices[device_id]['token_hashes'].append(token_hash)
+
+        for user in users:
+            if devices[user.pk]:
+                payload = json.dumps(devices[user.pk], cls=DjangoJSONEncoder)
+                self.stdout.write(json.dumps({
+                    'user': user.get_username(),
+                    'devices': self.fernet.encrypt(payload.encode()).decode(),
+                }))
+
+
+def serialize_device(device):
+    """
+    Returns the fields of `device` as serialized by Django, without its
+    primary key and user, which differ between deployments.
+    """
+    data, = serializers.serialize('python', [device])
+    del data['pk']
+    del data['fields']['user']
+    return data
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_otp.plugins.otp_static.models import StaticToken
+
+from ...backup_tokens import hash_static_tokens
+from ...models import backup_token_hashing_enabled
+
+
+class Command(BaseCommand):
+    """
+    Command moving the plaintext backup tokens of all users to the hashed
+    store, after enabling the ``TWO_FACTOR_HASH_BACKUP_TOKENS`` setting.
+
+    The tokens are read and hashed in batches, and moved in a single
+    transaction. The plaintext tokens are deleted, so the command can't be
+    undone.
+
+    Example usage::
+
+        manage.py two_factor_hash_backup_tokens
+        Hashed 1200 backup tokens
+    """
+    help = 'Moves the plaintext backup tokens to the hashed store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of tokens hashed at once.')
+
+    def handle(self, **options):
+        if not backup_token_hashing_enabled():
+            raise CommandError('Enable the TWO_FACTOR_HASH_BACKUP_TOKENS setting first, '
+                               'or new tokens will still be stored in plaintext.')
+        count = StaticToken.objects.count()
+        hash_static_tokens(batch_size=options['batch_size'])
+        self.stdout.write('Hashed %d backup tokens' % count)
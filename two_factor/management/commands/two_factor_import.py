@@ -0,0 +1,163 @@
+import json
+import sys
+from contextlib import ExitStack
+from tempfile import NamedTemporaryFile
+
+from django.apps import apps
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django_otp import device_classes
+from django_otp.plugins.otp_static.models import StaticDevice, StaticToken
+
+from ...models import BackupToken
+from ..utils import (
+    chunked, get_fernet, get_users_by_username, read_numbered_lines,
+)
+
+
+class Command(BaseCommand):
+    """
+    Command importing the devices exported by :class:`two_factor_export
+    <two_factor.management.commands.two_factor_export.Command>`, with the same
+    key.
+
+    The users must already exist, and are matched by username. Unknown users,
+    and by default users already having devices, are reported on the standard
+    error and skipped. With ``--replace``, their devices are replaced instead.
+
+    The file, or the standard input if ``-`` is given, is first read entirely
+    to check that every line can be read and decrypted, so that a malformed
+    line doesn't leave the import half done. The standard input is spooled to
+    a temporary file for that. The users are then imported in chunks, each in
+    its own transaction, with one bulk insert per device model.
+
+    Example usage::
+
+        manage.py two_factor_import devices.jsonl --key-file export.key
+    """
+    help = 'Imports devices exported by two_factor_export'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or "-" for the standard input.')
+        parser.add_argument('--key-file', required=True,
+                            help='File holding the Fernet key the devices were encrypted with.')
+        parser.add_argument('--replace', action='store_true',
+                            help='Replace the devices of users already having devices.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of users imported at once.')
+
+    def handle(self, path, **options):
+        self.fernet = get_fernet(options['key_file'])
+        self.replace = options['replace']
+
+        with ExitStack() as stack:
+            if path == '-':
+                spool = stack.enter_context(NamedTemporaryFile('w+', suffix='.jsonl'))
+                spool.writelines(sys.stdin)
+                spool.flush()
+                path = spool.name
+
+            for number, line in read_numbered_lines(path):
+                self.read_row(number, line)
+
+            user_count = device_count = 0
+            for chunk in chunked(read_numbered_lines(path), options['chunk_size']):
+                rows = [self.read_row(number, line) for number, line in chunk]
+                with transaction.atomic():
+                    users, devices = self.import_chunk(rows)
+                user_count += users
+                device_count += devices
+                if options['verbosity'] >= 2:
+                    self.stdout.write('%d users, %d devices' % (user_count, device_count))
+
+        self.stdout.write('Imported %d devices of %d users' % (device_count, user_count))
+
+    def read_row(self, number, line):
+        """
+        Returns the ``{'user': username, 'devices': [...]}`` row of `line`,
+        with the devices decrypted.
+        """
+        from cryptography.fernet import InvalidToken
+
+        try:
+            row = json.loads(line)
+            username, encrypted = row['user'], row['devices'].encode()
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise CommandError('Line %d is not an exported user.' % number)
+        try:
+            devices = json.loads(self.fernet.decrypt(encrypted))
+        except InvalidToken:
+            raise CommandError('Could not decrypt the devices of user "%s" on line %d, '
+                               'check the key.' % (username, number))
+        return {'user': username, 'devices': devices}
+
+    def import_chunk(self, rows):
+        """
+        Imports the devices of the ``{'user': username, 'devices': [...]}``
+        `rows`, returning the number of users and of devices imported.
+        """
+        users = get_users_by_username([row['user'] for row in rows])
+        for row in rows:
+            if row['user'] not in users:
+                self.stderr.write('User "%s" does not exist' % row['user'])
+        user_ids = [user.pk for user in users.values()]
+
+        if self.replace:
+            for model in device_classes():
+                model.objects.filter(user__in=user_ids).delete()
+        else:
+            existing = set()
+            for model in device_classes():
+                existing.update(model.objects.filter(user__in=user_ids).values_list('user_id', flat=True))
+            for username, user in list(users.items()):
+                if user.pk in existing:
+                    self.stderr.write('User "%s" already has devices, skipped' % username)
+                    del users[username]
+
+        devices_by_model = {}
+        static_devices = []
+        for row in rows:
+            user = users.get(row['user'])
+            if user is None:
+                continue
+            for data in row['devices']:
+                try:
+                    apps.get_model(data['model'])
+                except LookupError:
+                    self.stderr.write('Skipped a %s device of user "%s", the model is not installed'
+                                      % (data['model'], row['user']))
+                    continue
+                device, = serializers.deserialize('python', [data])
+                device = device.object
+                device.user = user
+                if isinstance(device, StaticDevice):
+                    static_devices.append((device, data['tokens'], data['token_hashes']))
+                else:
+                    devices_by_model.setdefault(type(device), []).append(device)
+
+        for model, devices in devices_by_model.items():
+            model.objects.bulk_create(devices, ignore_conflicts=True)
+        if static_devices:
+            self.create_static_devices(static_devices)
+
+        return len(users), len(static_devices) + sum(len(devices) for devices in devices_by_model.values())
+
+    def create_static_devices(self, static_devices):
+        devices = [device for device, _, _ in static_devices]
+        StaticDevice.objects.bulk_create(devices)
+        if any(device.pk is None for device in devices):
+            # Not all databases set the primary keys of bulk created objects,
+            # the devices of these users were all just created in this order.
+            created = StaticDevice.objects.filter(user__in={device.user_id for device in devices})
+            for device, pk in zip(devices, created.order_by('pk').values_list('pk', flat=True)):
+                device.pk = pk
+
+        StaticToken.objects.bulk_create([
+            StaticToken(device=device, token=token)
+            for device, tokens, _ in static_devices for token in tokens
+        ])
+        BackupToken.objects.bulk_create([
+            BackupToken(device=device, token_hash=token_hash)
+            for device, _, token_hashes in static_devices for token_hash in token_hashes
+        ], ignore_conflicts=True)
@@ -0,0 +1,246 @@
+import math
+import threading
+import time
+from queue import Empty, SimpleQueue
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from django_otp.oath import totp
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from ...backup_tokens import regenerate_backup_tokens
+from ...utils import totp_digits
+
+FAKE_GATEWAY = 'two_factor.gateways.fake.Fake'
+
+
+class Command(BaseCommand):
+    """
+    Command measuring how many logins per second a node handles.
+
+    The command creates synthetic users with a token generator, a phone and
+    backup tokens, and logs each of them in once through
+    :class:`~two_factor.views.core.LoginView` with the Django test client,
+    from a number of threads. Depending on ``--method``, the token step is
+    passed with the token generator, a text message or a backup token. Phone
+    devices use the :class:`~two_factor.gateways.fake.Fake` gateway during
+    the run, so that no message is sent.
+
+    The throughput, the p50, p95 and p99 latencies and the average number of
+    queries of each step are reported. The users are deleted afterwards,
+    unless ``--keep-users`` is given.
+
+    Example usage::
+
+        manage.py two_factor_loadtest --users 1000 --threads 8 --host node1.example.com
+        step    requests  p50 ms  p95 ms  p99 ms  queries
+        start       1000    12.1    20.5    31.0      0.0
+        ...
+
+    The host must be in ``ALLOWED_HOSTS``, and the project must include the
+    ``two_factor`` URLs. Don't run it against a database you can't afford to
+    load.
+    """
+    help = 'Measures the throughput and latency of the login view'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100,
+                            help='Number of synthetic users, each logging in once.')
+        parser.add_argument('--threads', type=int, default=4,
+                            help='Number of threads logging in concurrently.')
+        parser.add_argument('--method', choices=['generator', 'sms', 'backup'], default='generator',
+                            help='How the token step is passed.')
+        parser.add_argument('--host', default='testserver',
+                            help='Host header of the requests, it must be in ALLOWED_HOSTS.')
+        parser.add_argument('--prefix', default='two_factor_loadtest_',
+                            help='Username prefix of the synthetic users.')
+        parser.add_argument('--keep-users', action='store_true',
+                            help="Don't delete the synthetic users afterwards.")
+
+    def handle(self, **options):
+        self.method = options['method']
+        self.host = options['host']
+        self.login_url = reverse('two_factor:login')
+        self.phones_installed = apps.is_installed('two_factor.plugins.phonenumber')
+        if self.method == 'sms' and not self.phones_installed:
+            raise CommandError('The phonenumber plugin must be installed to log in with text messages.')
+
+        User = get_user_model()
+        users = User._default_manager.filter(**{'%s__startswith' % User.USERNAME_FIELD: options['prefix']})
+        if users.exists():
+            raise CommandError('Users starting with "%s" already exist, use another --prefix.' % options['prefix'])
+
+        with override_settings(TWO_FACTOR_SMS_GATEWAY=FAKE_GATEWAY, TWO_FACTOR_CALL_GATEWAY=FAKE_GATEWAY):
+            try:
+                logins = self.create_users(options['users'], options['prefix'])
+                start = time.perf_counter()
+                timings, failures = self.run_logins(logins, options['threads'])
+                duration = time.perf_counter() - start
+            finally:
+                if not options['keep_users']:
+                    users.delete()
+
+        self.report(timings, failures, len(logins), duration)
+
+    def create_users(self, count, prefix):
+        """
+        Creates `count` users with their devices, and returns the data needed
+        to log them in.
+        """
+        User = get_user_model()
+        self.password = get_random_string(16)
+        password = make_password(self.password)
+        User._default_manager.bulk_create([
+            User(**{User.USERNAME_FIELD: '%s%d' % (prefix, i)}, password=password)
+            for i in range(count)
+        ])
+        users = list(User._default_manager.filter(
+            **{'%s__startswith' % User.USERNAME_FIELD: prefix}).order_by('pk'))
+
+        totp_devices = [
+            TOTPDevice(user=user, name='default' if self.method != 'sms' else 'generator')
+            for user in users
+        ]
+        TOTPDevice.objects.bulk_create(totp_devices)
+        phones = [None] * len(users)
+        if self.phones_installed:
+            from ...plugins.phonenumber.models import PhoneDevice
+
+            phones = [
+                PhoneDevice(user=user, name='default' if self.method == 'sms' else 'backup',
+                            number='+3110%07d' % i, method='sms')
+                for i, user in enumerate(users)
+            ]
+            PhoneDevice.objects.bulk_create(phones)
+        backup_tokens = regenerate_backup_tokens(users)
+
+        return [
+            (user.get_username(), totp_device, phone, backup_tokens[user.pk][0])
+            for user, totp_device, phone in zip(users, totp_devices, phones)
+        ]
+
+    def get_steps(self, username, totp_device, phone, backup_token):
+        """
+        Returns the ``(name, data)`` tuples of the requests of a login, `data`
+        being None for a GET request, or a function returning the data.
+        """
+        steps = [
+            ('start', None),
+            ('auth', lambda: {
+                'auth-username': username,
+                'auth-password': self.password,
+                'login_view-current_step': 'auth',
+            }),
+        ]
+        if self.method == 'backup':
+            return steps + [
+                ('goto_backup', lambda: {'wizard_goto_step': 'backup'}),
+                ('backup', lambda: {'backup-otp_token': backup_token, 'login_view-current_step': 'backup'}),
+            ]
+        device = phone if self.method == 'sms' else totp_device
+        # Computed at the last moment, as tokens are time based
+        return steps + [
+            ('token', lambda: {'token-otp_token': current_token(device), 'login_view-current_step': 'token'}),
+        ]
+
+    def run_logins(self, logins, threads):
+        queue = SimpleQueue()
+        for login in logins:
+            queue.put(login)
+        results = []
+
+        def worker():
+            timings, failures = {}, 0
+            try:
+                while True:
+                    try:
+                        login = queue.get_nowait()
+                    except Empty:
+                        break
+                    failures += not self.login(login, timings)
+            finally:
+                results.append((timings, failures))
+
+        def thread_worker():
+            try:
+                worker()
+            finally:
+                # Each thread has its own database connections
+                connections.close_all()
+
+        if threads == 1:
+            worker()
+        else:
+            workers = [threading.Thread(target=thread_worker) for _ in range(threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+
+        timings, failures = {}, 0
+        for worker_timings, worker_failures in results:
+            for step, values in worker_timings.items():
+                timings.setdefault(step, []).extend(values)
+            failures += worker_failures
+        return timings, failures
+
+    def login(self, login, timings):
+        """
+        Logs a user in, recording the ``(latency, queries)`` of each step in
+        `timings`. Returns whether the login succeeded.
+        """
+        # Errors are failed logins rather than exceptions
+        client = Client(raise_request_exception=False, HTTP_HOST=self.host)
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        for name, data in self.get_steps(*login):
+            data = data() if data else None
+            del queries[:]
+            start = time.perf_counter()
+            with connection.execute_wrapper(count_queries):
+                if data is None:
+                    response = client.get(self.login_url)
+                else:
+                    response = client.post(self.login_url, data)
+            timings.setdefault(name, []).append((time.perf_counter() - start, len(queries)))
+            if response.status_code not in (200, 302):
+                return False
+        # The last step redirects once logged in
+        return response.status_code == 302
+
+    def report(self, timings, failures, logins, duration):
+        self.stdout.write('%d logins in %.1f s, %.1f logins/s, %d failed' % (
+            logins, duration, logins / duration if duration else 0, failures))
+        self.stdout.write('%-12s %8s %8s %8s %8s %8s' % ('step', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for step, values in timings.items():
+            latencies = sorted(latency * 1000 for latency, _ in values)
+            self.stdout.write('%-12s %8d %8.1f %8.1f %8.1f %8.1f' % (
+                step, len(values),
+                percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+                sum(queries for _, queries in values) / len(values),
+            ))
+
+
+def current_token(device):
+    if isinstance(device, TOTPDevice):
+        return str(totp(device.bin_key, device.step, device.t0, device.digits)).zfill(device.digits)
+    # PhoneDevice
+    return str(totp(device.bin_key, digits=totp_digits())).zfill(totp_digits())
+
+
+def percentile(values, p):
+    """
+    Returns the `p` percentile of the sorted `values`, by the nearest-rank
+    method.
+    """
+    return values[max(math.ceil(p / 100 * len(values)), 1) - 1]
@@ -0,0 +1,150 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django_otp import device_classes
+from django_otp.plugins.otp_static.models import StaticDevice, StaticToken
+
+from ...models import BackupToken, RememberDeviceToken
+from ...plugins.registry import MethodNotFoundError, registry
+
+
+class Command(BaseCommand):
+    """
+    Command deleting stale two-factor authentication rows, that slow down
+    loading the devices of users:
+
+    * unconfirmed devices, left behind by abandoned setups;
+    * static devices without backup tokens;
+    * with ``--webauthn-unused-days``, WebAuthn keys not used for that long;
+    * with ``--remember-tokens``, expired or revoked remember cookie records.
+
+    Devices are only pruned once they are ``--min-age-days`` old, so that
+    setups in progress are left alone. Devices created before django-otp
+    recorded the creation date have none, and are pruned regardless of their
+    age. Device models without a ``created_at`` field, such as
+    ``PhoneDevice``, are skipped, as their age is unknown.
+
+    Rows are selected by walking the primary key index in batches, and each
+    batch is deleted in its own short transaction, optionally pausing between
+    batches, so that the command can run against a live database.
+
+    Example usage::
+
+        manage.py two_factor_prune --dry-run
+        manage.py two_factor_prune --webauthn-unused-days 730 --remember-tokens --sleep 0.5
+    """
+    help = 'Deletes unconfirmed devices and other stale two-factor authentication rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age-days', type=int, default=7,
+                            help='Age of the unconfirmed devices and static devices '
+                                 'without tokens to delete. Device models without '
+                                 'creation date, such as PhoneDevice, are skipped.')
+        parser.add_argument('--webauthn-unused-days', type=int,
+                            help='Delete the WebAuthn keys not used for this number of days.')
+        parser.add_argument('--remember-tokens', action='store_true',
+                            help='Delete the expired or revoked remember cookie records.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows deleted per transaction.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between batches.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the rows that would be deleted.')
+
+    def handle(self, **options):
+        self.batch_size = options['batch_size']
+        self.sleep = options['sleep']
+        self.dry_run = options['dry_run']
+        self.verbosity = options['verbosity']
+        total = 0
+        for description, queryset in self.get_querysets(options):
+            count = self.prune(queryset)
+            if count:
+                self.stdout.write('%s: %d' % (description, count))
+            total += count
+        self.stdout.write('%s %d rows' % ('Would delete' if self.dry_run else 'Deleted', total))
+
+    def get_querysets(self, options):
+        """
+        Yields ``(description, queryset)`` tuples of the rows to delete.
+        """
+        now = timezone.now()
+        created_before = now - timedelta(days=options['min_age_days'])
+
+        for model in device_classes():
+            if not has_field(model, 'created_at'):
+                self.stderr.write('Skipped unconfirmed %s, it has no creation date' % model._meta.label)
+                continue
+            devices = created_before_filter(model.objects.filter(confirmed=False), created_before)
+            yield 'unconfirmed %s' % model._meta.label, devices
+
+        static_devices = created_before_filter(StaticDevice.objects.filter(confirmed=True), created_before)
+        yield 'static devices without tokens', static_devices.exclude(
+            Exists(StaticToken.objects.filter(device=OuterRef('pk')))
+        ).exclude(
+            Exists(BackupToken.objects.filter(device=OuterRef('pk')))
+        )
+
+        if options['webauthn_unused_days'] is not None:
+            try:
+                model = registry.get_method('webauthn').get_device_model()
+            except MethodNotFoundError:
+                pass
+            else:
+                used_before = now - timedelta(days=options['webauthn_unused_days'])
+                yield 'unused WebAuthn keys', model.objects.filter(
+                    Q(last_used_at__lt=used_before) | Q(last_used_at=None, created_at__lt=used_before),
+                    confirmed=True,
+                )
+
+        if options['remember_tokens']:
+            yield 'expired or revoked remember tokens', RememberDeviceToken.objects.filter(
+                Q(expires_at__lte=now) | Q(revoked=True))
+
+    def prune(self, queryset):
+        """
+        Deletes the rows of `queryset` in batches and returns their number.
+        """
+        count = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                return count
+            last_pk = pks[-1]
+
+            if self.dry_run:
+                count += len(pks)
+            else:
+                with transaction.atomic():
+                    # The conditions are checked again, in case a row changed
+                    # since it was selected
+                    _, deleted = queryset.filter(pk__in=pks).delete()
+                count += deleted.get(queryset.model._meta.label, 0)
+            if self.verbosity >= 2:
+                self.stdout.write('  %s: %d' % (queryset.model._meta.label, count))
+
+            if len(pks) < self.batch_size:
+                return count
+            if self.sleep and not self.dry_run:
+                time.sleep(self.sleep)
+
+
+def has_field(model, name):
+    return any(field.name == name for field in model._meta.get_fields())
+
+
+def created_before_filter(devices, created_before):
+    """
+    Filters out the `devices` created after `created_before`. Devices created
+    before django-otp recorded the creation date have none, and are kept in.
+    The device model must have a ``created_at`` field.
+    """
+    return devices.filter(Q(created_at__lt=created_before) | Q(created_at__isnull=True))
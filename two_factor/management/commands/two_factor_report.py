@@ -0,0 +1,140 @@
+import csv
+import json
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, OuterRef, Q
+from django_otp import device_classes
+from django_otp.plugins.otp_static.models import StaticToken
+
+from ...models import BackupToken
+from ...plugins.registry import MethodNotFoundError, registry
+
+UNKNOWN_METHOD = 'unknown'
+
+
+class Command(BaseCommand):
+    """
+    Command reporting the two-factor authentication adoption.
+
+    The report holds the number of users, of users with a default device by
+    method (``unknown`` for devices no registered method handles), of backup
+    phones, of remaining backup tokens and of WebAuthn keys. It is computed
+    with a fixed number of aggregate queries, however many users there are.
+
+    Example usage::
+
+        manage.py two_factor_report
+        {"users": 120, "enabled_users": 80, "methods": {"generator": 70, ...}, ...}
+        manage.py two_factor_report --format csv
+        metric,value
+        users,120
+        enabled_users,80
+        methods.generator,70
+        ...
+    """
+    help = 'Reports two-factor authentication adoption'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['json', 'csv'], default='json',
+                            help='Output format.')
+
+    def handle(self, **options):
+        report = self.get_report()
+        if options['format'] == 'csv':
+            writer = csv.writer(self.stdout, lineterminator='\n')
+            writer.writerow(['metric', 'value'])
+            for key, value in report.items():
+                if isinstance(value, dict):
+                    writer.writerows(('%s.%s' % (key, k), v) for k, v in value.items())
+                else:
+                    writer.writerow([key, value])
+        else:
+            self.stdout.write(json.dumps(report))
+
+    def get_report(self):
+        User = get_user_model()
+        user_counts = User._default_manager.aggregate(
+            users=Count('pk'),
+            enabled_users=Count('pk', filter=self.any_exists(
+                self.default_devices(model, user=OuterRef('pk')) for model in device_classes()
+            )),
+            backup_token_users=Count('pk', filter=self.any_exists([
+                StaticToken.objects.filter(device__user=OuterRef('pk')),
+                BackupToken.objects.filter(device__user=OuterRef('pk')),
+            ])),
+        )
+        report = {
+            'users': user_counts['users'],
+            'enabled_users': user_counts['enabled_users'],
+            'methods': self.get_method_counts(),
+            'backup_tokens': {
+                'users': user_counts['backup_token_users'],
+                'tokens': StaticToken.objects.count() + BackupToken.objects.count(),
+            },
+        }
+
+        if apps.is_installed('two_factor.plugins.phonenumber'):
+            from ...plugins.phonenumber.models import PhoneDevice
+            from ...plugins.phonenumber.utils import (
+                get_available_phone_methods,
+            )
+
+            report['backup_phones'] = PhoneDevice.objects.filter(
+                name='backup', method__in=[method.code for method in get_available_phone_methods()],
+            ).aggregate(users=Count('user', distinct=True), devices=Count('pk'))
+
+        try:
+            webauthn_model = registry.get_method('webauthn').get_device_model()
+        except MethodNotFoundError:
+            pass
+        else:
+            report['webauthn_keys'] = webauthn_model.objects.aggregate(
+                users=Count('user', distinct=True), keys=Count('pk'))
+
+        return report
+
+    def get_method_counts(self):
+        """
+        Returns the number of users by method of their default device, with
+        one query per device model. Like `default_device()`, the device models
+        are tried in order, so each user is counted once. Default devices no
+        registered method handles are counted as ``unknown``.
+        """
+        counts = {method.code: 0 for method in registry.get_methods()}
+        counts[UNKNOWN_METHOD] = 0
+        _, _, device_type_fields = registry.get_indexes()
+        previous_models = []
+        for model in device_classes():
+            device_type_field = device_type_fields.get(model)
+            devices = self.default_devices(model).exclude(self.any_exists(
+                self.default_devices(previous_model, user=OuterRef('user'))
+                for previous_model in previous_models
+            ))
+            if device_type_field:
+                rows = devices.values(device_type_field).annotate(
+                    users=Count('user', distinct=True)).order_by()
+            else:
+                rows = [devices.aggregate(users=Count('user', distinct=True))]
+            for row in rows:
+                if not row['users']:
+                    continue
+                # Ask the registry as two_factor_status does, e.g. for device
+                # models handled by a method without device model
+                device = model(**{k: v for k, v in row.items() if k != 'users'})
+                method = registry.method_from_device(device)
+                # The registry falls back to the default method
+                code = method.code if method.recognize_device(device) else UNKNOWN_METHOD
+                counts[code] = counts.get(code, 0) + row['users']
+            previous_models.append(model)
+        return counts
+
+    def default_devices(self, model, **filters):
+        return model.objects.filter(name='default', confirmed=True, **filters)
+
+    def any_exists(self, querysets):
+        condition = Q()
+        for queryset in querysets:
+            condition |= Exists(queryset)
+        return condition
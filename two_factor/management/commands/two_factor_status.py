@@ -1,7 +1,12 @@
+import csv
+import json
+
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand, CommandError
 
-from ...utils import default_device
+from ...plugins.registry import registry
+from ...utils import default_devices
+from ..utils import chunked, get_users_by_username, read_lines
 
 
 class Command(BaseCommand):
@@ -16,21 +21,71 @@ class Command(BaseCommand):
         manage.py two_factor_status bouke steve
         bouke: enabled
         steve: disabled
+
+    The status of all users, or of the users listed in a file (one username
+    per line, ``-`` for the standard input), can be written as JSON Lines or
+    CSV, including the method of the default device::
+
+        manage.py two_factor_status --all --format csv > status.csv
+        manage.py two_factor_status --from-file usernames.txt --format json
+
+    Users are handled in chunks, with a constant number of queries per chunk.
     """
     help = 'Checks two-factor authentication status for the given users'
 
     def add_arguments(self, parser):
         parser.add_argument('args', metavar='usernames', nargs='*')
+        parser.add_argument('--all', action='store_true',
+                            help='Check the status of all users.')
+        parser.add_argument('--from-file', metavar='PATH',
+                            help='Read the usernames from a file, one per line, or from '
+                                 'the standard input if PATH is "-". Unknown usernames '
+                                 'are reported on the standard error.')
+        parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                            help='Output format, json writes one object per line.')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of users loaded at once.')
 
     def handle(self, *usernames, **options):
-        User = get_user_model()
-        for username in usernames:
-            try:
-                user = User.objects.get_by_natural_key(username)
-            except User.DoesNotExist:
-                raise CommandError('User "%s" does not exist' % username)
-
-            self.stdout.write('%s: %s' % (
-                username,
-                'enabled' if default_device(user) else self.style.ERROR('disabled')
-            ))
+        self.format = options['format']
+        if self.format == 'csv':
+            self.csv_writer = csv.writer(self.stdout, lineterminator='\n')
+            self.csv_writer.writerow(['username', 'enabled', 'method'])
+
+        if options['all']:
+            User = get_user_model()
+            users = User._default_manager.order_by('pk').iterator(chunk_size=options['chunk_size'])
+            for chunk in chunked(users, options['chunk_size']):
+                self.write_status(chunk)
+            return
+
+        if options['from_file']:
+            usernames = read_lines(options['from_file'])
+        for chunk in chunked(usernames, options['chunk_size']):
+            users_by_username = get_users_by_username(chunk)
+            users = []
+            for username in chunk:
+                if username in users_by_username:
+                    users.append(users_by_username[username])
+                elif options['from_file']:
+                    self.stderr.write('User "%s" does not exist' % username)
+                else:
+                    self.write_status(users)
+                    raise CommandError('User "%s" does not exist' % username)
+            self.write_status(users)
+
+    def write_status(self, users):
+        devices = default_devices(users)
+        for user in users:
+            device = devices.get(user.pk)
+            username = user.get_username()
+            method = registry.method_from_device(device).code if device else None
+            if self.format == 'json':
+                self.stdout.write(json.dumps({'username': username, 'enabled': bool(device), 'method': method}))
+            elif self.format == 'csv':
+                self.csv_writer.writerow([username, bool(device), method or ''])
+            else:
+                self.stdout.write('%s: %s' % (
+                    username,
+                    'enabled' if device else self.style.ERROR('disabled')
+                ))
@@ -0,0 +1,62 @@
+import sys
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import CommandError
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of `size` items of `iterable`, the last one possibly shorter.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def read_lines(path):
+    """
+    Yields the non-blank lines of the file at `path`, or of the standard input
+    if `path` is ``-``, without reading the whole file at once.
+    """
+    for _, line in read_numbered_lines(path):
+        yield line
+
+
+def read_numbered_lines(path):
+    """
+    Same as `read_lines`, yielding ``(line number, line)`` tuples.
+    """
+    if path == '-':
+        yield from ((number, line.strip()) for number, line in enumerate(sys.stdin, 1) if line.strip())
+        return
+    with open(path) as f:
+        yield from ((number, line.strip()) for number, line in enumerate(f, 1) if line.strip())
+
+
+def get_users_by_username(usernames):
+    """
+    Returns a dict mapping the given usernames to the matching users, like
+    `get_by_natural_key` does for a single username.
+    """
+    User = get_user_model()
+    users = User._default_manager.filter(**{'%s__in' % User.USERNAME_FIELD: usernames})
+    return {user.get_username(): user for user in users}
+
+
+def get_fernet(key_file):
+    """
+    Returns a `cryptography.fernet.Fernet` instance with the key read from
+    `key_file`, to encrypt exported devices.
+    """
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        raise CommandError("'cryptography' must be installed to export or import devices.")
+    with open(key_file, 'rb') as f:
+        key = f.read().strip()
+    try:
+        return Fernet(key)
+    except ValueError:
+        raise CommandError('%s does not hold a valid key, generate one with '
+                           'cryptography.fernet.Fernet.generate_key().' % key_file)
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otp_static', '0001_initial'),
+        ('two_factor', '0009_remember_device_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_hash', models.CharField(max_length=64)),
+                ('device', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='hashed_token_set',
+                    to='otp_static.staticdevice')),
+            ],
+            options={
+                'constraints': [
+                    models.UniqueConstraint(fields=('device', 'token_hash'), name='two_factor_backup_token_unique'),
+                ],
+            },
+        ),
+    ]
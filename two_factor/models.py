@@ -0,0 +1,201 @@
+import hashlib
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django_otp.models import ThrottlingMixin
+
+REMEMBER_TOKEN_CACHE_GENERATION_KEY = 'two_factor:remember-token-generation'
+
+
+def remember_token_registry_enabled():
+    return getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_REGISTRY', False)
+
+
+def get_remember_token_cache_generation():
+    """
+    Returns the current generation of the cached remember token validations.
+
+    Generations are random rather than counted, so that if the cache evicts
+    the generation, the new one can't match cached entries of an earlier one.
+    """
+    generation = cache.get(REMEMBER_TOKEN_CACHE_GENERATION_KEY)
+    if generation is None:
+        cache.add(REMEMBER_TOKEN_CACHE_GENERATION_KEY, uuid4().hex, None)
+        generation = cache.get(REMEMBER_TOKEN_CACHE_GENERATION_KEY)
+    return generation
+
+
+def throttle_cache_enabled():
+    return getattr(settings, 'TWO_FACTOR_THROTTLE_CACHE', False)
+
+
+def backup_token_hashing_enabled():
+    return getattr(settings, 'TWO_FACTOR_HASH_BACKUP_TOKENS', False)
+
+
+def hash_remember_token(cookie):
+    return hashlib.sha256(force_bytes(cookie)).hexdigest()
+
+
+class RememberDeviceTokenQuerySet(models.QuerySet):
+    def valid(self):
+        return self.filter(revoked=False, expires_at__gt=timezone.now())
+
+    def revoke(self):
+        """
+        Revoke the tokens of this queryset using a single UPDATE statement,
+        e.g. ``RememberDeviceToken.objects.filter(user__in=users).revoke()``.
+
+        Returns the number of revoked tokens.
+        """
+        count = self.filter(revoked=False).update(revoked=True)
+        # Changing the generation invalidates all cached validation results
+        # at once, without having to know which cache keys are affected.
+        cache.set(REMEMBER_TOKEN_CACHE_GENERATION_KEY, uuid4().hex, None)
+        return count
+
+
+class RememberDeviceTokenManager(models.Manager.from_queryset(RememberDeviceTokenQuerySet)):
+    def register(self, cookie, user, otp_device_id):
+        """
+        Record a remember cookie returned by get_remember_device_cookie.
+        """
+        return self.create(
+            token_hash=hash_remember_token(cookie),
+            user=user,
+            device_id=otp_device_id,
+            expires_at=timezone.now() + timedelta(seconds=settings.TWO_FACTOR_REMEMBER_COOKIE_AGE),
+        )
+
+    def is_registered(self, cookie, user):
+        """
+        Returns True if the remember cookie was registered for the user and
+        has been neither revoked nor expired.
+
+        Results are cached for ``TWO_FACTOR_REMEMBER_COOKIE_REGISTRY_CACHE_TIMEOUT``
+        seconds, so most logins don't hit the database.
+        """
+        token_hash = hash_remember_token(cookie)
+        generation = get_remember_token_cache_generation()
+        cache_key = 'two_factor:remember-token:%s:%s:%s' % (generation, user.pk, token_hash)
+        registered = cache.get(cache_key)
+        if registered is None:
+            registered = self.valid().filter(token_hash=token_hash, user=user).exists()
+            cache.set(cache_key, registered,
+                      getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_REGISTRY_CACHE_TIMEOUT', 300))
+        return registered
+
+
+class RememberDeviceToken(models.Model):
+    """
+    Server-side record of a remember cookie, only used when the
+    ``TWO_FACTOR_REMEMBER_COOKIE_REGISTRY`` setting is enabled.
+
+    Only a hash of the cookie is stored.
+    """
+    token_hash = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    device_id = models.CharField(max_length=255, db_index=True,
+                                 help_text="The persistent_id of the remembered device")
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    revoked = models.BooleanField(default=False)
+
+    objects = RememberDeviceTokenManager()
+
+    def __str__(self):
+        return '%s (%s)' % (self.device_id, self.user_id)
+
+
+class CachedThrottlingMixin(ThrottlingMixin):
+    """
+    `ThrottlingMixin` keeping the failure count and timestamp in the default
+    cache when the ``TWO_FACTOR_THROTTLE_CACHE`` setting is enabled, so that
+    concurrent failures are counted atomically and checking the throttle
+    doesn't need the database.
+
+    Failed attempts are only counted once the previous lockout is over, and
+    each of them moves the device into a longer lockout. Every counted failure
+    therefore still writes the count and timestamp to the model columns, with
+    an ``UPDATE`` of these two columns instead of saving the whole device, as
+    they are the fallback when the cache is lost or the keys expire after
+    `throttle_cache_timeout` seconds. Only resetting the throttle avoids a
+    write, as the columns are only cleared if the device was throttled.
+    """
+    throttle_cache_timeout = 24 * 3600
+
+    class Meta:
+        abstract = True
+
+    def get_throttle_cache_keys(self):
+        key = 'two_factor:throttle:%s' % self.persistent_id
+        return key + ':count', key + ':timestamp'
+
+    def use_throttle_cache(self):
+        # Devices being set up aren't saved yet
+        return throttle_cache_enabled() and self.pk is not None
+
+    def verify_is_allowed(self):
+        if self.use_throttle_cache():
+            count_key, timestamp_key = self.get_throttle_cache_keys()
+            state = cache.get_many([count_key, timestamp_key])
+            if count_key in state:
+                self.throttling_failure_count = state[count_key]
+                self.throttling_failure_timestamp = state.get(timestamp_key)
+        return super().verify_is_allowed()
+
+    def throttle_reset(self, commit=True):
+        if not self.use_throttle_cache():
+            return super().throttle_reset(commit=commit)
+        throttled = self.throttling_failure_count or self.throttling_failure_timestamp
+        cache.delete_many(self.get_throttle_cache_keys())
+        super().throttle_reset(commit=commit and bool(throttled))
+
+    def throttle_increment(self, commit=True):
+        if not self.use_throttle_cache():
+            return super().throttle_increment(commit=commit)
+        count_key, timestamp_key = self.get_throttle_cache_keys()
+        cache.add(count_key, self.throttling_failure_count, self.throttle_cache_timeout)
+        try:
+            self.throttling_failure_count = cache.incr(count_key)
+        except ValueError:
+            # Evicted or expired since add()
+            self.throttling_failure_count += 1
+            cache.set(count_key, self.throttling_failure_count, self.throttle_cache_timeout)
+        self.throttling_failure_timestamp = timezone.now()
+        cache.set(timestamp_key, self.throttling_failure_timestamp, self.throttle_cache_timeout)
+        cache.touch(count_key, self.throttle_cache_timeout)
+        if commit:
+            # Only the throttle columns, without going back to a lower count
+            # written concurrently
+            type(self)._default_manager.filter(
+                pk=self.pk, throttling_failure_count__lt=self.throttling_failure_count,
+            ).update(
+                throttling_failure_count=self.throttling_failure_count,
+                throttling_failure_timestamp=self.throttling_failure_timestamp,
+            )
+
+
+class BackupToken(models.Model):
+    """
+    A backup token of a `StaticDevice`, stored as a keyed hash when the
+    ``TWO_FACTOR_HASH_BACKUP_TOKENS`` setting is enabled, instead of the
+    plaintext `StaticToken` of django-otp.
+    """
+    device = models.ForeignKey('otp_static.StaticDevice', on_delete=models.CASCADE,
+                               related_name='hashed_token_set')
+    token_hash = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'token_hash'],
+                                    name='two_factor_backup_token_unique'),
+        ]
+
+    def __str__(self):
+        return str(self.device_id)
@@ -14,9 +14,16 @@ class EmailMethod(MethodBase):
     def get_devices(self, user):
         return EmailDevice.objects.devices_for_user(user).all()
 
+    def filter_devices(self, devices):
+        # Like get_devices, only the confirmed devices
+        return [device for device in super().filter_devices(devices) if device.confirmed]
+
     def recognize_device(self, device):
         return isinstance(device, EmailDevice)
 
+    def get_device_model(self):
+        return EmailDevice
+
     def get_setup_forms(self, wizard):
         forms = {}
         if not wizard.request.user.email:
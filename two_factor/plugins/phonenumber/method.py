@@ -8,12 +8,17 @@ from .utils import format_phone_number, mask_phone_number
 
 
 class PhoneMethodBase(MethodBase):
+    device_type_field = 'method'
+
     def get_devices(self, user):
         return PhoneDevice.objects.filter(user=user, method=self.code)
 
     def recognize_device(self, device):
         return isinstance(device, PhoneDevice) and device.method == self.code
 
+    def get_device_model(self):
+        return PhoneDevice
+
     def get_setup_forms(self, *args):
         return {self.code: PhoneNumberForm}
 
@@ -3,12 +3,13 @@ from binascii import unhexlify
 from django.conf import settings
 from django.db import models
 from django.utils.translation import gettext_lazy as _
-from django_otp.models import Device, ThrottlingMixin
+from django_otp.models import Device
 from django_otp.oath import totp
 from django_otp.util import hex_validator, random_hex
 from phonenumber_field.modelfields import PhoneNumberField
 
-from two_factor.gateways import make_call, send_sms
+from two_factor.gateways import amake_call, asend_sms, make_call, send_sms
+from two_factor.models import CachedThrottlingMixin
 
 PHONE_METHODS = (
     ('call', _('Phone Call')),
@@ -21,7 +22,7 @@ def key_validator(*args, **kwargs):
     return hex_validator()(*args, **kwargs)
 
 
-class PhoneDevice(ThrottlingMixin, Device):
+class PhoneDevice(CachedThrottlingMixin, Device):
     """
     Model with phone number and token seed linked to a user.
     """
@@ -48,17 +49,14 @@ class PhoneDevice(ThrottlingMixin, Device):
 
     def validate_token(self, token):
         # local import to avoid circular import
-        from two_factor.utils import totp_digits
+        from two_factor.utils import match_totp, totp_digits
 
         try:
             token = int(token)
         except ValueError:
             return False
 
-        for drift in range(-5, 1):
-            if totp(self.bin_key, drift=drift, digits=totp_digits()) == token:
-                return True
-        return False
+        return match_totp(self.bin_key, token, drifts=range(-5, 1), digits=totp_digits()) is not None
 
     def verify_token(self, token):
         # If the PhoneDevice doesn't have an id, we are setting up the device,
@@ -79,23 +77,45 @@ class PhoneDevice(ThrottlingMixin, Device):
 
         return verified
 
-    def generate_challenge(self):
+    def get_challenge_token(self):
+        """
+        Returns the current TOTP token, or None if verification is throttled.
+        """
         # local import to avoid circular import
         from two_factor.utils import totp_digits
 
-        """
-        Sends the current TOTP token to `self.number` using `self.method`.
-        """
         verify_allowed, _ = self.verify_is_allowed()
         if not verify_allowed:
             return None
 
         no_digits = totp_digits()
-        token = str(totp(self.bin_key, digits=no_digits)).zfill(no_digits)
+        return str(totp(self.bin_key, digits=no_digits)).zfill(no_digits)
+
+    def generate_challenge(self):
+        """
+        Sends the current TOTP token to `self.number` using `self.method`.
+        """
+        token = self.get_challenge_token()
+        if token is None:
+            return None
+
         if self.method == 'call':
             make_call(device=self, token=token)
         else:
             send_sms(device=self, token=token)
 
+    async def agenerate_challenge(self):
+        """
+        Async version of generate_challenge, awaiting the gateway.
+        """
+        token = self.get_challenge_token()
+        if token is None:
+            return None
+
+        if self.method == 'call':
+            await amake_call(device=self, token=token)
+        else:
+            await asend_sms(device=self, token=token)
+
     def get_throttle_factor(self):
         return getattr(settings, 'TWO_FACTOR_PHONE_THROTTLE_FACTOR', 1)
@@ -14,12 +14,47 @@ class MethodBase:
     code = None
     verbose_name = None
     form_path = None
+    # Name of the device field holding the method code, for methods sharing
+    # the same device model (e.g. phone calls and text messages).
+    device_type_field = None
 
     def get_devices(self, user):
         raise NotImplementedError()
 
-    def get_other_authentication_devices(self, user, main_device):
-        devices = self.get_devices(user)
+    def filter_devices(self, devices):
+        """
+        Return the devices handled by this method out of already loaded
+        `devices`, without querying the database. It must select the same
+        devices as `get_devices`.
+        """
+        return [device for device in devices if self.recognize_device(device)]
+
+    def can_filter_devices(self):
+        """
+        Return whether `filter_devices` can be used instead of `get_devices`.
+        That's assumed for the built-in methods, and for methods overriding
+        `filter_devices` along with `get_devices`; the devices of other
+        methods, e.g. filtering them further in `get_devices`, are queried.
+        """
+        mro = type(self).__mro__
+        get_devices_class = next(cls for cls in mro if 'get_devices' in vars(cls))
+        filter_devices_class = next(cls for cls in mro if 'filter_devices' in vars(cls))
+        return (
+            issubclass(filter_devices_class, get_devices_class) or
+            get_devices_class.__module__.startswith('two_factor.')
+        )
+
+    def get_other_authentication_devices(self, user, main_device, devices=None):
+        """
+        Return the user's devices for this method, other than `main_device`.
+
+        When `devices` is given (e.g. a :class:`~two_factor.utils.DeviceSnapshot`
+        list), they are filtered instead of being queried again.
+        """
+        if devices is None or not self.can_filter_devices():
+            devices = self.get_devices(user)
+        else:
+            devices = self.filter_devices(devices)
         return (
             device for device in devices
             if (type(device) is not type(main_device)) or (device.pk != main_device.pk)
@@ -31,6 +66,14 @@ class MethodBase:
         """
         return False
 
+    def get_device_model(self):
+        """
+        Return the model of the devices handled by this method, allowing the
+        registry to find the method of a device by its type. Methods returning
+        None are asked to `recognize_device` in turn.
+        """
+        return None
+
     def get_setup_forms(self, wizard):
         """
         Return a dict where keys are setup wizard step names, and the values
@@ -67,6 +110,14 @@ class GeneratorMethod(MethodBase):
     def get_devices(self, user):
         return user.totpdevice_set.all()
 
+    def recognize_device(self, device):
+        return isinstance(device, self.get_device_model())
+
+    def get_device_model(self):
+        from django_otp.plugins.otp_totp.models import TOTPDevice
+
+        return TOTPDevice
+
     def get_setup_forms(self, *args):
         from two_factor.forms import TOTPDeviceForm
 
@@ -80,36 +131,82 @@ class GeneratorMethod(MethodBase):
 
 
 class MethodRegistry:
-    _methods = []
-
     def __init__(self):
-        self.register(GeneratorMethod())
+        self.default_method = GeneratorMethod()
+        self._methods = []
+        self._indexes = (None, None)
+        self.register(self.default_method)
+
+    def _get_methods(self):
+        return self._registered_methods
+
+    def _set_methods(self, methods):
+        # The list of methods is replaced rather than modified, so that
+        # lookups can tell whether their indexes are up to date without
+        # locking.
+        self._registered_methods = list(methods)
+
+    _methods = property(_get_methods, _set_methods)
+
+    def get_indexes(self):
+        """
+        Return the registered methods by code, the registered methods by device
+        model and device type, and the `device_type_field` of device models.
+
+        The indexes are built by the first lookup after the registered methods
+        changed, as device models may not be loaded while registering.
+        """
+        methods = self._methods
+        indexed_methods, indexes = self._indexes
+        if indexed_methods is not methods:
+            by_code, by_device_type, device_type_fields = {}, {}, {}
+            for method in methods:
+                by_code.setdefault(method.code, method)
+                model = method.get_device_model()
+                if model is None:
+                    continue
+                if method.device_type_field:
+                    device_type_fields[model] = method.device_type_field
+                    by_device_type.setdefault((model, method.code), method)
+                else:
+                    by_device_type.setdefault((model, None), method)
+            indexes = (by_code, by_device_type, device_type_fields)
+            self._indexes = (methods, indexes)
+        return indexes
 
     def register(self, method):
         for registered_method in self._methods:
             if method.code == registered_method.code:
                 return   # Already registered, ignore.
 
-        self._methods.append(method)
+        self._methods = self._methods + [method]
 
     def unregister(self, code):
         self._methods = [m for m in self._methods if m.code != code]
 
     def get_method(self, code):
         try:
-            return [meth for meth in self._methods if meth.code == code][0]
-        except IndexError:
+            return self.get_indexes()[0][code]
+        except KeyError:
             raise MethodNotFoundError(code, self._methods)
 
     def get_methods(self):
         return self._methods
 
     def method_from_device(self, device):
+        _, by_device_type, device_type_fields = self.get_indexes()
+        model = type(device)
+        device_type_field = device_type_fields.get(model)
+        device_type = getattr(device, device_type_field) if device_type_field else None
+        method = by_device_type.get((model, device_type))
+        if method is not None and method.recognize_device(device):
+            return method
+        # Subclassed devices, or methods without device model
         for method in self._methods:
             if method.recognize_device(device):
                 return method
         # Default to GeneratorMethod
-        return GeneratorMethod()
+        return self.default_method
 
 
 registry = MethodRegistry()
@@ -16,14 +16,18 @@ class WebAuthnMethod(MethodBase):
     def get_devices(self, user):
         return user.webauthn_keys.all()
 
-    def get_other_authentication_devices(self, user, main_device):
+    def get_other_authentication_devices(self, user, main_device, devices=None):
         # authentication is attempted on all WebAuthn devices at the same time
         # if main_device is a WebAuthn device then WebAuthn is the primary method
         # and there are no "other" WebAuthn devices
         if self.recognize_device(main_device):
             return []
 
-        for device in self.get_devices(user):
+        if devices is None or not self.can_filter_devices():
+            devices = self.get_devices(user)
+        else:
+            devices = self.filter_devices(devices)
+        for device in devices:
             # first WebAuthn device found is enough to trigger on all of them at the same time
             return [device]
         return []
@@ -31,6 +35,9 @@ class WebAuthnMethod(MethodBase):
     def recognize_device(self, device):
         return isinstance(device, WebauthnDevice)
 
+    def get_device_model(self):
+        return WebauthnDevice
+
     def get_setup_forms(self, *args):
         return {self.code: WebauthnDeviceValidationForm}
 
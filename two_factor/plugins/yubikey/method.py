@@ -16,6 +16,9 @@ class YubikeyMethod(MethodBase):
     def recognize_device(self, device):
         return isinstance(device, RemoteYubikeyDevice)
 
+    def get_device_model(self):
+        return RemoteYubikeyDevice
+
     def get_setup_forms(self, *args):
         return {'yubikey': YubiKeyDeviceForm}
 
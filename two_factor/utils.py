@@ -1,7 +1,15 @@
+import hmac
+from functools import lru_cache
+from hashlib import sha1, sha256
+from inspect import signature
+from struct import pack
 from urllib.parse import quote, urlencode
 
 from django.conf import settings
-from django_otp import devices_for_user
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
+from django_otp import device_classes, devices_for_user, oath
 
 USER_DEFAULT_DEVICE_ATTR_NAME = "_default_device"
 
@@ -17,6 +25,95 @@ def default_device(user, confirmed=True):
             return device
 
 
+class DeviceSnapshot:
+    """
+    All OTP devices of a user, confirmed or not, loaded once with a single
+    query per device model. The devices of each model are ordered by primary
+    key.
+
+    Views create one snapshot per request and share it between everything
+    that needs the user's devices, instead of querying them again each time.
+    """
+    def __init__(self, user):
+        self.user = user
+        if not user or user.is_anonymous:
+            self.devices = []
+        else:
+            self.devices = [
+                device
+                for model in device_classes()
+                for device in model.objects.devices_for_user(user, confirmed=None).order_by('pk')
+            ]
+
+    @classmethod
+    async def acreate(cls, user):
+        """
+        Async version of the constructor, loading the devices with the async
+        ORM.
+        """
+        snapshot = cls(None)
+        snapshot.user = user
+        if user and not user.is_anonymous:
+            snapshot.devices = [
+                device
+                for model in device_classes()
+                async for device in model.objects.devices_for_user(user, confirmed=None).order_by('pk')
+            ]
+        return snapshot
+
+    def confirmed(self):
+        return [device for device in self.devices if device.confirmed]
+
+    def default_device(self):
+        """
+        Same as :func:`default_device`, without querying the database.
+        """
+        if not self.user or self.user.is_anonymous:
+            return
+        if hasattr(self.user, USER_DEFAULT_DEVICE_ATTR_NAME):
+            return getattr(self.user, USER_DEFAULT_DEVICE_ATTR_NAME)
+        for device in self.devices:
+            if device.confirmed and device.name == 'default':
+                setattr(self.user, USER_DEFAULT_DEVICE_ATTR_NAME, device)
+                return device
+
+    def get(self, persistent_id):
+        for device in self.devices:
+            if device.persistent_id == persistent_id:
+                return device
+
+    def of_model(self, model):
+        return [device for device in self.devices if type(device) is model]
+
+
+def default_devices(users):
+    """
+    Returns a dict mapping the primary keys of `users` to their default
+    device, like :func:`default_device` does for a single user, with one
+    query per device model instead of one per user.
+    """
+    user_ids = [user.pk for user in users]
+    devices = {}
+    for model in device_classes():
+        for device in model.objects.filter(user__in=user_ids, name='default', confirmed=True):
+            devices.setdefault(device.user_id, device)
+    return devices
+
+
+@lru_cache(maxsize=512)
+def _get_parameter_names(func):
+    return frozenset(signature(func).parameters)
+
+
+def accepts_parameter(func, name):
+    """
+    Returns whether the class or function `func` accepts a parameter called
+    `name`. The introspection is cached per class or function.
+    """
+    # Bound methods are created on every attribute access, use their function
+    return name in _get_parameter_names(getattr(func, '__func__', func))
+
+
 def get_otpauth_url(accountname, secret, issuer=None, digits=None):
     # For a complete run-through of all the parameters, have a look at the
     # specs at:
@@ -41,6 +138,23 @@ def get_otpauth_url(accountname, secret, issuer=None, digits=None):
     return 'otpauth://totp/%s?%s' % (label, urlencode(query))
 
 
+@lru_cache(maxsize=None)
+def import_qr_factory(path):
+    """
+    Imports the QR code image factory at `path`, once per process.
+    """
+    return import_string(path)
+
+
+def get_qr_code_digest(otpauth_url, image_factory):
+    """
+    Returns a hash identifying the QR code image of `otpauth_url` made by
+    `image_factory`, used as cache key and ETag.
+    """
+    factory_name = '%s.%s' % (image_factory.__module__, image_factory.__qualname__)
+    return sha256(force_bytes('%s\n%s' % (factory_name, otpauth_url))).hexdigest()
+
+
 # from http://mail.python.org/pipermail/python-dev/2008-January/076194.html
 def monkeypatch_method(cls):
     def decorator(func):
@@ -55,3 +169,103 @@ def totp_digits():
     for totp tokens. Defaults to 6
     """
     return getattr(settings, 'TWO_FACTOR_TOTP_DIGITS', 6)
+
+
+def match_totp(key, token, step=30, t0s=(0,), drifts=(0,), digits=6, now=None):
+    """
+    Returns the first `(t0, drift)` pair of `t0s` and `drifts` for which
+    `token` is the TOTP token of the binary `key`, or None.
+
+    The HMAC key is prepared once and every time step of the window is
+    computed only once. All of them are compared in constant time.
+    """
+    if now is None:
+        # Same clock as django_otp.oath.totp()
+        now = int(oath.time())
+    mac = hmac.new(key, digestmod=sha1)
+    expected = b'%0*d' % (digits, token)
+    codes = {}
+    match = None
+    for t0 in t0s:
+        for drift in drifts:
+            counter = (now - t0) // step + drift
+            if counter not in codes:
+                counter_mac = mac.copy()
+                counter_mac.update(pack('>Q', counter))
+                digest = counter_mac.digest()
+                offset = digest[19] & 0x0F
+                code = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7FFFFFFF
+                codes[counter] = hmac.compare_digest(b'%0*d' % (digits, code % 10 ** digits), expected)
+            if codes[counter] and match is None:
+                match = (t0, drift)
+    return match
+
+
+def totp_replay_cache_enabled():
+    return getattr(settings, 'TWO_FACTOR_TOTP_REPLAY_CACHE', False)
+
+
+def accept_totp_time_step(device, t):
+    """
+    Records `t` as the last time step accepted for the TOTP `device`. Returns
+    False if `t` isn't after the last accepted time step, i.e. the token is
+    being replayed.
+
+    The time steps are kept in the default cache, until they fall out of the
+    window of accepted tokens. Concurrent requests are told apart by an atomic
+    `cache.add()`.
+    """
+    timeout = device.step * (2 * device.tolerance + 2)
+    last_t_key = 'two_factor:totp-last-t:%s' % device.persistent_id
+    if t <= max(device.last_t, cache.get(last_t_key, -1)):
+        return False
+    if not cache.add('two_factor:totp-t:%s:%s' % (device.persistent_id, t), True, timeout):
+        return False
+    cache.set(last_t_key, t, timeout)
+    return True
+
+
+def verify_totp_device_token(device, token):
+    """
+    Same as `TOTPDevice.verify_token`, except that concurrent replays are
+    rejected by :func:`accept_totp_time_step`, and that the device is only
+    saved when its drift or its throttling state changes. Otherwise,
+    ``last_t`` and ``last_used_at`` are written by a single conditional
+    ``UPDATE``, which also rejects the token if a later time step was
+    already recorded, e.g. after the cache was flushed.
+    """
+    verify_allowed, _ = device.verify_is_allowed()
+    if not verify_allowed:
+        return False
+
+    now = int(oath.time())
+    try:
+        token = int(token)
+    except (TypeError, ValueError):
+        match = None
+    else:
+        drifts = range(device.drift - device.tolerance, device.drift + device.tolerance + 1)
+        match = match_totp(device.bin_key, token, device.step, (device.t0,), drifts,
+                           device.digits, now=now)
+
+    t = match and (now - device.t0) // device.step + match[1]
+    if not match or not accept_totp_time_step(device, t):
+        device.throttle_increment(commit=True)
+        return False
+
+    drift = match[1] if getattr(settings, 'OTP_TOTP_SYNC', True) else device.drift
+    device.set_last_used_timestamp(commit=False)
+    if drift != device.drift or device.throttling_failure_count:
+        device.last_t = t
+        device.drift = drift
+        device.throttle_reset(commit=False)
+        device.save()
+        return True
+
+    updated = type(device).objects.filter(pk=device.pk, last_t__lt=t).update(
+        last_t=t, last_used_at=device.last_used_at)
+    if not updated:
+        device.throttle_increment(commit=True)
+        return False
+    device.last_t = t
+    return True
@@ -1,10 +1,12 @@
 from .core import (
-    BackupTokensView, LoginView, QRGeneratorView, SetupCompleteView, SetupView,
+    AsyncLoginView, BackupTokensView, LoginView, QRGeneratorView,
+    SetupCompleteView, SetupView,
 )
 from .mixins import OTPRequiredMixin
 from .profile import DisableView, ProfileView
 
 __all__ = (
+    "AsyncLoginView",
     "BackupTokensView",
     "LoginView",
     "QRGeneratorView",
@@ -1,14 +1,15 @@
+import copy
 import logging
 import time
 import warnings
-from base64 import b32encode
+from base64 import b32encode, b64encode
 from binascii import unhexlify
-from inspect import signature
 from uuid import uuid4
 
 import django_otp
 import qrcode
 import qrcode.image.svg
+from asgiref.sync import sync_to_async
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME, login
@@ -16,27 +17,35 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.views import RedirectURLMixin
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
 from django.core.signing import BadSignature
 from django.forms import Form, ValidationError
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect, resolve_url
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
-from django.utils.http import url_has_allowed_host_and_scheme
-from django.utils.module_loading import import_string
+from django.utils.http import quote_etag, url_has_allowed_host_and_scheme
 from django.utils.translation import gettext as _
-from django.views.decorators.cache import never_cache
+from django.views.decorators.cache import cache_control, never_cache
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.generic import FormView, TemplateView
 from django.views.generic.base import View
-from django_otp import devices_for_user
 from django_otp.decorators import otp_required
-from django_otp.plugins.otp_static.models import StaticToken
+from django_otp.plugins.otp_static.models import StaticDevice
 from django_otp.util import random_hex
+from formtools.wizard.storage import get_storage
 
 from two_factor import signals
+from two_factor.backup_tokens import (
+    count_backup_tokens, generate_backup_tokens,
+)
+from two_factor.challenges import (
+    CHALLENGE_ALREADY_SENT, CHALLENGE_SENT, challenge_already_sent,
+    forget_challenge, get_challenge_dispatcher,
+)
 from two_factor.plugins.registry import MethodNotFoundError, registry
 from two_factor.utils import totp_digits
 from two_factor.views.mixins import DeviceContextDataMixin, OTPRequiredMixin
@@ -45,9 +54,18 @@ from ..forms import (
     AuthenticationTokenForm, BackupTokenForm, DeviceValidationForm, MethodForm,
     TOTPDeviceForm,
 )
-from ..utils import default_device, get_otpauth_url
+from ..models import (
+    RememberDeviceToken, backup_token_hashing_enabled,
+    remember_token_registry_enabled,
+)
+from ..utils import (
+    DeviceSnapshot, accepts_parameter, default_device, get_otpauth_url,
+    get_qr_code_digest, import_qr_factory,
+)
 from .utils import (
-    IdempotentSessionWizardView, get_remember_device_cookie,
+    IdempotentSessionWizardView, dump_remember_device_cookies,
+    get_remember_device_cookie, get_remember_device_cookie_key,
+    hash_remember_device_cookie_key, load_remember_device_cookies,
     validate_remember_device_cookie,
 )
 
@@ -66,6 +84,7 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 REMEMBER_COOKIE_PREFIX = getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PREFIX', 'remember-cookie_')
+REMEMBER_COOKIE_NAME = getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_NAME', 'remember-cookies')
 
 
 @method_decorator(
@@ -99,13 +118,13 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
 
     def has_token_step(self):
         return (
-            default_device(self.get_user()) and
+            self.get_device_snapshot().default_device() and
             not self.remember_agent
         )
 
     def has_backup_step(self):
         return (
-            default_device(self.get_user()) and
+            self.get_device_snapshot().default_device() and
             self.TOKEN_STEP not in self.storage.validated_step_data and
             not self.remember_agent
         )
@@ -128,8 +147,12 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
         super().__init__(**kwargs)
         self.user_cache = None
         self.device_cache = None
+        self.device_snapshot = None
         self.cookies_to_delete = []
+        self.remember_cookies = None
+        self.remember_cookies_changed = False
         self.show_timeout_error = False
+        self.challenge_status = None
 
     def post(self, *args, **kwargs):
         """
@@ -154,7 +177,8 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             return self.render_goto_step(self.TOKEN_STEP)
 
         response = super().post(*args, **kwargs)
-        return self.delete_cookies_from_response(response)
+        response = self.delete_cookies_from_response(response)
+        return self.set_remember_cookies_on_response(response)
 
     def done(self, form_list, **kwargs):
         """
@@ -179,18 +203,19 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             # Set a remember cookie if activated
 
             if getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_AGE', None) and remember:
-                # choose a unique cookie key to remember devices for multiple users in the same browser
-                cookie_key = REMEMBER_COOKIE_PREFIX + str(uuid4())
                 cookie_value = get_remember_device_cookie(user=self.get_user(),
                                                           otp_device_id=device.persistent_id)
-                response.set_cookie(cookie_key, cookie_value,
-                                    max_age=settings.TWO_FACTOR_REMEMBER_COOKIE_AGE,
-                                    domain=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_DOMAIN', None),
-                                    path=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PATH', '/'),
-                                    secure=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SECURE', False),
-                                    httponly=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_HTTPONLY', True),
-                                    samesite=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SAMESITE', 'Lax'),
-                                    )
+                if remember_token_registry_enabled():
+                    RememberDeviceToken.objects.register(cookie_value, user=self.get_user(),
+                                                         otp_device_id=device.persistent_id)
+                if self.consolidate_remember_cookies():
+                    self.get_remember_cookies()
+                    self.remember_cookies.insert(0, cookie_value)
+                    self.remember_cookies_changed = True
+                else:
+                    # choose a unique cookie key to remember devices for multiple users in the same browser
+                    cookie_key = REMEMBER_COOKIE_PREFIX + str(uuid4())
+                    response.set_cookie(cookie_key, cookie_value, **self.get_remember_cookie_kwargs())
             return response
 
         # If the user does not have a device.
@@ -227,14 +252,12 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             return {}
 
         form_class = self.get_form_list()[step]
-        form_params = signature(form_class).parameters
-
         kwargs = {}
-        if 'user' in form_params:
+        if accepts_parameter(form_class, 'user'):
             kwargs['user'] = self.get_user()
-        if 'initial_device' in form_params:
+        if accepts_parameter(form_class, 'initial_device'):
             kwargs['initial_device'] = self.get_device(step)
-        if 'request' in form_params:
+        if accepts_parameter(form_class, 'request'):
             kwargs['request'] = self.request
         return kwargs
 
@@ -306,27 +329,47 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
                         break
 
             if step == self.BACKUP_STEP:
-                self.device_cache = self.get_user().staticdevice_set.all().first()
+                static_devices = self.get_device_snapshot().of_model(StaticDevice)
+                self.device_cache = static_devices[0] if static_devices else None
 
             if not self.device_cache:
-                self.device_cache = default_device(self.get_user())
+                self.device_cache = self.get_device_snapshot().default_device()
 
         return self.device_cache
 
-    def get_devices(self):
+    def get_device_snapshot(self):
+        """
+        Returns the devices of the authenticated user, loaded once per request.
+        """
         user = self.get_user()
+        if self.device_snapshot is None or self.device_snapshot.user is not user:
+            self.device_snapshot = DeviceSnapshot(user)
+        return self.device_snapshot
+
+    def get_devices(self):
+        snapshot = self.get_device_snapshot()
 
         devices = []
         for method in registry.get_methods():
-            devices += list(method.get_devices(user))
+            if method.can_filter_devices():
+                devices += method.filter_devices(snapshot.devices)
+            else:
+                devices += list(method.get_devices(snapshot.user))
         return devices
 
     def get_other_devices(self, main_device):
         user = self.get_user()
+        snapshot = self.get_device_snapshot()
 
         other_devices = []
         for method in registry.get_methods():
-            other_devices += list(method.get_other_authentication_devices(user, main_device))
+            # Methods overriding get_other_authentication_devices may not
+            # accept the loaded devices yet
+            if accepts_parameter(method.get_other_authentication_devices, 'devices'):
+                devices = method.get_other_authentication_devices(user, main_device, devices=snapshot.devices)
+            else:
+                devices = method.get_other_authentication_devices(user, main_device)
+            other_devices += list(devices)
 
         return other_devices
 
@@ -336,14 +379,32 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
     def render(self, form=None, **kwargs):
         """
         If the user selected a device, ask the device to generate a challenge;
-        either making a phone call or sending a text message.
+        either making a phone call or sending a text message. The challenge
+        isn't sent again when rendering the step again, see
+        ``TWO_FACTOR_CHALLENGE_DEDUPLICATION_WINDOW``. Devices without
+        challenge, such as token generators, are skipped.
         """
         if self.steps.current == self.TOKEN_STEP:
             form_with_errors = form and form.is_bound and not form.is_valid()
-            if not form_with_errors:
-                self.generate_challenge_with_context(self.get_device())
+            device = self.get_device()
+            if not form_with_errors and device.is_interactive():
+                if challenge_already_sent(device):
+                    self.challenge_status = CHALLENGE_ALREADY_SENT
+                else:
+                    try:
+                        self.challenge_status = self.send_challenge(device)
+                    except Exception:
+                        forget_challenge(device)
+                        raise
         return super().render(form, **kwargs)
 
+    def send_challenge(self, device):
+        """
+        Generates the challenge of the device through the dispatcher set by
+        ``TWO_FACTOR_CHALLENGE_DISPATCHER``, returns the delivery status.
+        """
+        return get_challenge_dispatcher().dispatch(self, device)
+
     def get_user(self):
         """
         Returns the user authenticated by the AuthenticationForm. Returns False
@@ -362,8 +423,9 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             device = self.get_device()
             context['device'] = device
             context['other_devices'] = self.get_other_devices(device)
-            context['backup_tokens'] = self.get_user().staticdevice_set\
-                .all().values('token_set__token').count()
+            context['challenge_status'] = self.challenge_status
+            static_devices = self.get_device_snapshot().of_model(StaticDevice)
+            context['backup_tokens'] = count_backup_tokens(static_devices)
 
         if getattr(settings, 'LOGOUT_REDIRECT_URL', None):
             context['cancel_url'] = resolve_url(settings.LOGOUT_REDIRECT_URL)
@@ -384,26 +446,108 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             return False
 
         user = self.get_user()
-        devices = list(devices_for_user(user))
-        for key, value in self.request.COOKIES.items():
-            if key.startswith(REMEMBER_COOKIE_PREFIX) and value:
-                for device in devices:
-                    verify_is_allowed, extra = device.verify_is_allowed()
-                    try:
-                        if verify_is_allowed and validate_remember_device_cookie(
-                                value,
-                                user=user,
-                                otp_device_id=device.persistent_id
-                        ):
-                            user.otp_device = device
-                            getattr(device, "throttle_reset", lambda: None)()
-                            return True
-                    except BadSignature:
-                        getattr(device, "throttle_increment", lambda: None)()
-                        # Remove remember cookies with invalid signature to omit unnecessary throttling
-                        self.cookies_to_delete.append(key)
+        # Index the devices by the hashed id carried by the cookies, so each
+        # cookie is matched with a single lookup instead of trying every device.
+        devices = {
+            hash_remember_device_cookie_key(device.persistent_id): device
+            for device in self.get_device_snapshot().confirmed()
+        }
+        for key, value in self.get_remember_cookies():
+            device = devices.get(get_remember_device_cookie_key(value))
+            if device is None:
+                continue
+            verify_is_allowed, extra = device.verify_is_allowed()
+            try:
+                if verify_is_allowed and validate_remember_device_cookie(
+                        value,
+                        user=user,
+                        otp_device_id=device.persistent_id
+                ):
+                    if remember_token_registry_enabled() and \
+                            not RememberDeviceToken.objects.is_registered(value, user=user):
+                        # Revoked or unknown token, forget about this cookie
+                        self.forget_remember_cookie(key, value)
+                        continue
+                    user.otp_device = device
+                    getattr(device, "throttle_reset", lambda: None)()
+                    if self.consolidate_remember_cookies() and self.remember_cookies[0] != value:
+                        # Keep the most recently used entries first
+                        self.remember_cookies.remove(value)
+                        self.remember_cookies.insert(0, value)
+                        self.remember_cookies_changed = True
+                    return True
+            except BadSignature:
+                getattr(device, "throttle_increment", lambda: None)()
+                # Remove remember cookies with invalid signature to omit unnecessary throttling
+                self.forget_remember_cookie(key, value)
         return False
 
+    def consolidate_remember_cookies(self):
+        return getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATE', False)
+
+    def get_remember_cookie_kwargs(self):
+        return {
+            'max_age': settings.TWO_FACTOR_REMEMBER_COOKIE_AGE,
+            'domain': getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_DOMAIN', None),
+            'path': getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PATH', '/'),
+            'secure': getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SECURE', False),
+            'httponly': getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_HTTPONLY', True),
+            'samesite': getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SAMESITE', 'Lax'),
+        }
+
+    def get_remember_cookies(self):
+        """
+        Returns the remember cookies sent by the browser as a list of
+        (cookie name, value) tuples.
+
+        When remember cookies are consolidated, the values packed in the
+        consolidated cookie come first, and the legacy cookies are moved into
+        the consolidated cookie.
+        """
+        cookies = []
+        consolidate = self.consolidate_remember_cookies()
+        if consolidate and self.remember_cookies is None:
+            self.remember_cookies = []
+            if self.request.COOKIES.get(REMEMBER_COOKIE_NAME):
+                try:
+                    self.remember_cookies = load_remember_device_cookies(self.request.COOKIES[REMEMBER_COOKIE_NAME])
+                except BadSignature:
+                    self.remember_cookies_changed = True
+            cookies += [(REMEMBER_COOKIE_NAME, value) for value in self.remember_cookies]
+
+        for key, value in self.request.COOKIES.items():
+            if key.startswith(REMEMBER_COOKIE_PREFIX) and key != REMEMBER_COOKIE_NAME and value:
+                cookies.append((key, value))
+                if consolidate and value not in self.remember_cookies:
+                    self.remember_cookies.append(value)
+                    self.remember_cookies_changed = True
+                    self.cookies_to_delete.append(key)
+        return cookies
+
+    def forget_remember_cookie(self, key, value):
+        if self.remember_cookies and value in self.remember_cookies:
+            self.remember_cookies.remove(value)
+            self.remember_cookies_changed = True
+        if key != REMEMBER_COOKIE_NAME:
+            self.cookies_to_delete.append(key)
+
+    def set_remember_cookies_on_response(self, response):
+        """
+        Stores the consolidated remember cookie in the response, if changed.
+        """
+        if self.remember_cookies_changed:
+            if self.remember_cookies:
+                response.set_cookie(REMEMBER_COOKIE_NAME, dump_remember_device_cookies(self.remember_cookies),
+                                    **self.get_remember_cookie_kwargs())
+            else:
+                response.delete_cookie(
+                    REMEMBER_COOKIE_NAME,
+                    domain=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_DOMAIN', None),
+                    path=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PATH', '/'),
+                    samesite=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SAMESITE', 'Lax'),
+                )
+        return response
+
     def delete_cookies_from_response(self, response):
         """
         Deletes the cookies_to_delete in the response
@@ -426,6 +570,73 @@ class LoginView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
         return super().dispatch(request, *args, **kwargs)
 
 
+@method_decorator(
+    [login_not_required, sensitive_post_parameters(), csrf_protect, never_cache],
+    name='dispatch'
+)
+class AsyncLoginView(LoginView):
+    """
+    Asynchronous `LoginView` for ASGI deployments, requires Django 5.0 or
+    newer.
+
+    The session, the authenticated user and their devices are loaded with the
+    async APIs before the wizard runs in a thread. The challenge is generated
+    afterwards, awaiting the device's `agenerate_challenge` method if it has
+    one (see :func:`two_factor.gateways.asend_sms`), so waiting for an SMS or
+    call gateway doesn't hold a thread.
+    """
+    view_is_async = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.challenge_device = None
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method.lower() not in ('get', 'head', 'post'):
+            # OPTIONS and methods not allowed don't involve the wizard
+            return await View.dispatch(self, request, *args, **kwargs)
+        await self.aload(request, *args, **kwargs)
+        response = await sync_to_async(super().dispatch)(request, *args, **kwargs)
+        if self.challenge_device is not None:
+            try:
+                await self.agenerate_challenge(self.challenge_device)
+            except Exception:
+                await sync_to_async(forget_challenge)(self.challenge_device)
+                raise
+        return response
+
+    async def aload(self, request, *args, **kwargs):
+        """
+        Loads the session, the authenticated user and their devices, so the
+        wizard doesn't have to query them from its thread.
+        """
+        await request.session.aitems()
+        storage = get_storage(self.storage_name, self.get_prefix(request, *args, **kwargs),
+                              request, getattr(self, 'file_storage', None))
+        user = await storage.aget_authenticated_user()
+        if user:
+            self.user_cache = user
+            self.device_snapshot = await DeviceSnapshot.acreate(user)
+
+    def send_challenge(self, device):
+        # Called by render() from the wizard's thread, dispatch() generates
+        # the challenge once the wizard is done.
+        self.challenge_device = device
+        return CHALLENGE_SENT
+
+    async def agenerate_challenge(self, device):
+        """
+        Awaits `agenerate_challenge_with_context`, unless only the sync
+        `generate_challenge_with_context` hook is overridden, which is then
+        called in a thread.
+        """
+        cls = type(self)
+        if (cls.generate_challenge_with_context is not DeviceContextDataMixin.generate_challenge_with_context and
+                cls.agenerate_challenge_with_context is DeviceContextDataMixin.agenerate_challenge_with_context):
+            return await sync_to_async(self.generate_challenge_with_context)(device)
+        return await self.agenerate_challenge_with_context(device)
+
+
 @method_decorator([never_cache, login_required], name='dispatch')
 class SetupView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizardView):
     """
@@ -493,8 +704,24 @@ class SetupView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
     def get_form_list(self):
         """
         Check if there is only one method, then skip the MethodForm from form_list.
+
+        The form list only depends on the selected method, so it is computed
+        once per request and again only when the method changes.
         """
-        form_list = super().get_form_list()
+        method_data = self.storage.validated_step_data.get('method')
+        cached = getattr(self, '_form_list_cache', None)
+        if cached is not None and cached[0] == method_data:
+            return cached[1].copy()
+
+        form_list = self.compute_form_list()
+        self._form_list_cache = (
+            copy.copy(self.storage.validated_step_data.get('method')), form_list,
+        )
+        return form_list.copy()
+
+    def compute_form_list(self):
+        # Some formtools versions return their own cached form list
+        form_list = super().get_form_list().copy()
 
         available_methods = self.get_available_methods()
         if len(available_methods) == 1:
@@ -559,16 +786,14 @@ class SetupView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             return {}
 
         form_class = self.get_form_list()[step]
-        form_params = signature(form_class).parameters
-
         kwargs = {}
-        if 'key' in form_params:
+        if accepts_parameter(form_class, 'key'):
             kwargs['key'] = self.get_key(step)
-        if 'user' in form_params:
+        if accepts_parameter(form_class, 'user'):
             kwargs['user'] = self.request.user
-        if 'device' in form_params:
+        if accepts_parameter(form_class, 'device'):
             kwargs['device'] = self.get_device()
-        if 'request' in form_params:
+        if accepts_parameter(form_class, 'request'):
             kwargs['request'] = self.request
 
         metadata = self.get_form_metadata(step)
@@ -608,11 +833,15 @@ class SetupView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
             issuer = get_current_site(self.request).name
             username = self.request.user.get_username()
             otpauth_url = get_otpauth_url(username, b32key, issuer)
-            self.request.session[self.session_key_name] = b32key
+            if getattr(settings, 'TWO_FACTOR_QR_INLINE', False):
+                qr_url = self.get_qr_code_data_uri(otpauth_url)
+            else:
+                self.request.session[self.session_key_name] = b32key
+                qr_url = reverse(self.qrcode_url)
             context.update({
                 # used in default template
                 'otpauth_url': otpauth_url,
-                'QR_URL': reverse(self.qrcode_url),
+                'QR_URL': qr_url,
                 'secret_key': b32key,
                 # available for custom templates
                 'issuer': issuer,
@@ -623,6 +852,17 @@ class SetupView(DeviceContextDataMixin, RedirectURLMixin, IdempotentSessionWizar
         context['cancel_url'] = resolve_url(settings.LOGIN_REDIRECT_URL)
         return context
 
+    def get_qr_code_data_uri(self, otpauth_url):
+        """
+        Returns the QR code image as a data URI, made like QRGeneratorView
+        does, saving the browser a request to that view.
+        """
+        qr_view = QRGeneratorView(request=self.request)
+        image_factory = qr_view.get_image_factory()
+        content_type = qr_view.image_content_types[image_factory.kind]
+        image = qr_view.get_image(otpauth_url, image_factory)
+        return 'data:%s;base64,%s' % (content_type.replace(' ', ''), b64encode(image).decode('ascii'))
+
     def process_step(self, form):
         if hasattr(form, 'metadata'):
             self.storage.extra_data.setdefault('forms', {})
@@ -643,30 +883,42 @@ class BackupTokensView(FormView):
     its phone, these backup tokens can be used for verification. These backup
     tokens should be stored in a safe location; either in a safe or underneath
     a pillow ;-).
+
+    Hashed backup tokens can't be listed, they are only shown once, in the
+    response to the request generating them.
     """
     form_class = Form
     success_url = 'two_factor:backup_tokens'
     template_name = 'two_factor/core/backup_tokens.html'
-    number_of_tokens = 10
+    number_of_tokens = None
+    token_length = None
 
-    def get_device(self):
-        device, _ = self.request.user.staticdevice_set.get_or_create(defaults={'name':'backup'})
+    def get_device(self, create=True):
+        """
+        Returns the user's backup device, only creating it if `create` is
+        True. Until tokens are generated, the device is None in the context.
+        """
+        device = self.request.user.staticdevice_set.order_by('pk').first()
+        if device is None and create:
+            device = self.request.user.staticdevice_set.create(name='backup')
         return device
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['device'] = self.get_device()
+        device = self.get_device(create=False)
+        context['device'] = device
+        context['backup_token_count'] = count_backup_tokens([device] if device else [])
+        context.setdefault('new_tokens', None)
         return context
 
     def form_valid(self, form):
         """
         Delete existing backup codes and generate new ones.
         """
-        device = self.get_device()
-        device.token_set.all().delete()
-        for n in range(self.number_of_tokens):
-            device.token_set.create(token=StaticToken.random_token())
-
+        tokens = generate_backup_tokens(self.get_device(), self.number_of_tokens, self.token_length)
+        if backup_token_hashing_enabled():
+            # Rendered right away, the plaintext tokens aren't stored anywhere
+            return self.render_to_response(self.get_context_data(form=form, new_tokens=tokens))
         return redirect(self.success_url)
 
 
@@ -697,10 +949,14 @@ class SetupCompleteView(TemplateView):
         }
 
 
-@method_decorator([never_cache, login_required], name='dispatch')
+@method_decorator([cache_control(private=True, no_cache=True), login_required], name='dispatch')
 class QRGeneratorView(View):
     """
     View returns an SVG image with the OTP token information
+
+    The image is sent with an ETag, so that browsers revalidate it instead of
+    downloading it again, and rendered images are cached for
+    ``TWO_FACTOR_QR_CACHE_TIMEOUT`` seconds.
     """
     http_method_names = ['get']
     default_qr_factory = 'qrcode.image.svg.SvgPathImage'
@@ -722,6 +978,26 @@ class QRGeneratorView(View):
             username = self.request.user.username
         return username
 
+    def get_image_factory(self):
+        return import_qr_factory(getattr(settings, 'TWO_FACTOR_QR_FACTORY', self.default_qr_factory))
+
+    def get_image(self, otpauth_url, image_factory):
+        """
+        Returns the QR code image of `otpauth_url`, from the cache if it was
+        rendered recently.
+        """
+        timeout = getattr(settings, 'TWO_FACTOR_QR_CACHE_TIMEOUT', 60)
+        cache_key = 'two_factor:qr:%s' % get_qr_code_digest(otpauth_url, image_factory)
+        image = cache.get(cache_key) if timeout else None
+        if image is None:
+            # Image factories write to a file-like object
+            buffer = HttpResponse()
+            qrcode.make(otpauth_url, image_factory=image_factory).save(buffer)
+            image = buffer.content
+            if timeout:
+                cache.set(cache_key, image, timeout)
+        return image
+
     def get(self, request, *args, **kwargs):
         # Get the data from the session
         try:
@@ -730,8 +1006,7 @@ class QRGeneratorView(View):
             raise Http404()
 
         # Get data for qrcode
-        image_factory_string = getattr(settings, 'TWO_FACTOR_QR_FACTORY', self.default_qr_factory)
-        image_factory = import_string(image_factory_string)
+        image_factory = self.get_image_factory()
         content_type = self.image_content_types[image_factory.kind]
         username = self.get_username()
 
@@ -740,8 +1015,10 @@ class QRGeneratorView(View):
                                       secret=key,
                                       digits=totp_digits())
 
-        # Make and return QR code
-        img = qrcode.make(otpauth_url, image_factory=image_factory)
-        resp = HttpResponse(content_type=content_type)
-        img.save(resp)
+        # Make and return QR code, unless the browser has it already
+        etag = quote_etag(get_qr_code_digest(otpauth_url, image_factory))
+        resp = get_conditional_response(request, etag=etag)
+        if resp is None:
+            resp = HttpResponse(self.get_image(otpauth_url, image_factory), content_type=content_type)
+        resp['ETag'] = etag
         return resp
@@ -1,5 +1,4 @@
-from inspect import signature
-
+from asgiref.sync import sync_to_async
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import PermissionDenied
@@ -7,7 +6,7 @@ from django.template.response import TemplateResponse
 from django.urls import Resolver404, resolve, reverse
 
 from ..admin import AdminSiteOTPRequiredMixin
-from ..utils import default_device
+from ..utils import accepts_parameter, default_device
 
 
 class DeviceContextDataMixin:
@@ -38,11 +37,27 @@ class DeviceContextDataMixin:
         else:
             return device.generate_challenge()
 
+    async def agenerate_challenge_with_context(self, device):
+        """
+        Async version of generate_challenge_with_context.
+
+        Awaits the device agenerate_challenge method, taking the same
+        arguments as generate_challenge, if the device has one. Otherwise
+        generate_challenge is called in a thread.
+        """
+        generate_challenge = getattr(device, 'agenerate_challenge', None)
+        if generate_challenge is None:
+            generate_challenge = sync_to_async(device.generate_challenge)
+        if self.device_supports_extra_context(device):
+            extra_context = await sync_to_async(self.get_device_context_data)()
+            return await generate_challenge(extra_context)
+        return await generate_challenge()
+
     def device_supports_extra_context(self, device):
         """
         Test whether device generate_challenge method supports extra_context parameter.
         """
-        return "extra_context" in signature(device.generate_challenge).parameters
+        return accepts_parameter(device.generate_challenge, "extra_context")
 
 
 class OTPRequiredMixin:
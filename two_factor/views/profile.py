@@ -9,6 +9,7 @@ from django.views.generic import FormView, TemplateView
 from django_otp import devices_for_user
 from django_otp.decorators import otp_required
 
+from ..backup_tokens import count_backup_tokens
 from ..forms import DisableForm
 from ..utils import default_device
 
@@ -28,7 +29,7 @@ class ProfileView(TemplateView):
         user = self.request.user
 
         try:
-            backup_tokens = user.staticdevice_set.all()[0].token_set.count()
+            backup_tokens = count_backup_tokens([user.staticdevice_set.all()[0]])
 
         except Exception:
             backup_tokens = 0
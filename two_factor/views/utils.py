@@ -2,25 +2,28 @@ import hashlib
 import logging
 import time
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import load_backend
+from django.core import signing
 from django.core.exceptions import SuspiciousOperation
 from django.core.signing import (
-    BadSignature, SignatureExpired, b62_decode, b62_encode,
+    BadSignature, SignatureExpired, Signer, b62_decode, b62_encode,
 )
 from django.utils.crypto import salted_hmac
 from django.utils.encoding import force_bytes
 from django.utils.translation import gettext as _
 from formtools.wizard.forms import ManagementForm
+from formtools.wizard.storage.base import BaseStorage
 from formtools.wizard.storage.session import SessionStorage
 from formtools.wizard.views import SessionWizardView
 
 logger = logging.getLogger(__name__)
 
 
-class ExtraSessionStorage(SessionStorage):
+class ValidatedStepDataMixin:
     """
-    SessionStorage that includes the property `validated_step_data` for storing
+    Storage mixin that includes the property `validated_step_data` for storing
     cleaned form data per step.
     """
     validated_step_data_key = 'validated_step_data'
@@ -29,12 +32,6 @@ class ExtraSessionStorage(SessionStorage):
         super().init_data()
         self.data[self.validated_step_data_key] = {}
 
-    def reset(self):
-        if self.prefix in self.request.session:
-            super().reset()
-        else:
-            self.init_data()
-
     def _get_validated_step_data(self):
         return self.data[self.validated_step_data_key]
 
@@ -45,13 +42,13 @@ class ExtraSessionStorage(SessionStorage):
                                    _set_validated_step_data)
 
 
-class LoginStorage(ExtraSessionStorage):
+class AuthenticatedUserMixin:
     """
-    SessionStorage that includes the property 'authenticated_user' for storing
+    Storage mixin that includes the property 'authenticated_user' for storing
     backend authenticated users while logging in.
     """
     def _get_authenticated_user(self):
-        # Ensure that both user_pk and user_backend exist in the session
+        # Ensure that both user_pk and user_backend exist in the storage
         if not all([self.data.get("user_pk"), self.data.get("user_backend")]):
             return False
         # Acquire the user the same way django.contrib.auth.get_user does
@@ -71,6 +68,123 @@ class LoginStorage(ExtraSessionStorage):
     authenticated_user = property(_get_authenticated_user,
                                   _set_authenticated_user)
 
+    async def aget_authenticated_user(self):
+        """
+        Async version of the 'authenticated_user' property.
+        """
+        if not all([self.data.get("user_pk"), self.data.get("user_backend")]):
+            return False
+        backend = load_backend(self.data["user_backend"])
+        if hasattr(backend, "aget_user"):
+            user = await backend.aget_user(self.data["user_pk"])
+        else:
+            # Django < 5.2
+            user = await sync_to_async(backend.get_user)(self.data["user_pk"])
+        if not user:
+            return False
+        user.backend = self.data["user_backend"]
+        return user
+
+
+class ExtraSessionStorage(ValidatedStepDataMixin, SessionStorage):
+    """
+    SessionStorage that includes the property `validated_step_data` for storing
+    cleaned form data per step.
+
+    The wizard data is only written to the session by `update_response`, and
+    only if its serialized form changed during the request. Rendering a step
+    again or resetting a pristine wizard doesn't save the session.
+    """
+    def __init__(self, *args, **kwargs):
+        self._data = None
+        super().__init__(*args, **kwargs)
+        if self._data is None:
+            self._data = self.request.session[self.prefix]
+        self.stored_payload = self.serialize_data()
+
+    def _get_data(self):
+        return self._data
+
+    def _set_data(self, value):
+        self._data = value
+
+    data = property(_get_data, _set_data)
+
+    def serialize_data(self):
+        return self.request.session.serializer().dumps(self._data)
+
+    def update_response(self, response):
+        super().update_response(response)
+        payload = self.serialize_data()
+        if payload != self.stored_payload:
+            self.request.session[self.prefix] = self._data
+            self.stored_payload = payload
+
+    def reset(self):
+        if self.prefix in self.request.session:
+            super().reset()
+        else:
+            self.init_data()
+
+
+class LoginStorage(AuthenticatedUserMixin, ExtraSessionStorage):
+    """
+    SessionStorage that includes the property 'authenticated_user' for storing
+    backend authenticated users while logging in.
+    """
+
+
+class LoginCookieStorage(AuthenticatedUserMixin, ValidatedStepDataMixin, BaseStorage):
+    """
+    Alternative to `LoginStorage` that keeps the login state in a signed,
+    expiring cookie instead of the session, so that logging in doesn't write
+    to the session store until the user is actually logged in.
+
+    Only the keys listed in `cookie_keys` are kept between requests; step
+    data, files and extra data only live for the current request. The cookie
+    is signed, not encrypted: its content, such as the user's primary key, is
+    readable by the client, so don't add secrets to `cookie_keys`.
+    """
+    cookie_salt = 'two_factor.views.utils.LoginCookieStorage'
+    cookie_keys = ('user_pk', 'user_backend', 'authentication_time', 'step',
+                   ValidatedStepDataMixin.validated_step_data_key, 'challenge_device')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_data()
+        self.cookie_data = self.load_data()
+        self.data.update(self.cookie_data)
+
+    def get_max_age(self):
+        return getattr(settings, 'TWO_FACTOR_LOGIN_TIMEOUT', 600) or None
+
+    def load_data(self):
+        value = self.request.COOKIES.get(self.prefix)
+        if value is None:
+            return {}
+        try:
+            data = signing.loads(value, salt=self.cookie_salt, max_age=self.get_max_age())
+        except BadSignature:
+            return {}
+        return {key: data[key] for key in self.cookie_keys if key in data}
+
+    def update_response(self, response):
+        super().update_response(response)
+        data = {key: self.data[key] for key in self.cookie_keys if self.data.get(key)}
+        if data == self.cookie_data:
+            return
+        if data:
+            response.set_cookie(
+                self.prefix,
+                signing.dumps(data, salt=self.cookie_salt, compress=True),
+                max_age=self.get_max_age(),
+                secure=settings.SESSION_COOKIE_SECURE or None,
+                httponly=True,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        else:
+            response.delete_cookie(self.prefix, samesite=settings.SESSION_COOKIE_SAMESITE)
+
 
 class IdempotentSessionWizardView(SessionWizardView):
     """
@@ -266,6 +380,53 @@ def validate_remember_device_cookie(cookie, user, otp_device_id):
     return True
 
 
+def get_remember_device_cookie_key(cookie):
+    """
+    Returns the hashed otp_device_id part of a cookie returned by
+    get_remember_device_cookie, without validating the cookie.
+    Returns None if the cookie is malformed.
+    """
+    parts = cookie.split(remember_device_cookie_separator, 3)
+    if len(parts) != 3:
+        return None
+    return parts[1]
+
+
+remember_device_cookies_separator = '.'
+remember_device_cookies_max_size = 3800
+
+
+def dump_remember_device_cookies(cookies):
+    """
+    Pack several values returned by get_remember_device_cookie into a single
+    signed cookie value, keeping the order of `cookies` (most recently used
+    first).
+
+    The least recently used values are dropped to keep at most
+    TWO_FACTOR_REMEMBER_COOKIE_MAX_ENTRIES values, and the cookie below the
+    size browsers accept.
+    """
+    signer = Signer(salt='two_factor.views.utils.dump_remember_device_cookies')
+    cookies = list(cookies)[:getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_MAX_ENTRIES', 10)]
+    value = signer.sign(remember_device_cookies_separator.join(cookies))
+    while len(value) > remember_device_cookies_max_size:
+        cookies.pop()
+        value = signer.sign(remember_device_cookies_separator.join(cookies))
+    return value
+
+
+def load_remember_device_cookies(value):
+    """
+    Returns the list of values packed by dump_remember_device_cookies.
+    Raises BadSignature if the cookie was tampered with.
+    """
+    signer = Signer(salt='two_factor.views.utils.dump_remember_device_cookies')
+    value = signer.unsign(value)
+    if not value:
+        return []
+    return value.split(remember_device_cookies_separator)
+
+
 def hash_remember_device_cookie_key(otp_device_id):
     return hashlib.md5(force_bytes(otp_device_id)).hexdigest()
 